@@ -4,14 +4,26 @@ import json
 import logging
 import time
 import uuid
+from collections import OrderedDict
 from typing import AsyncGenerator
 
-import langid
 from fastapi import HTTPException
-
-from chat import chat_storage_manager
+from langid.langid import LanguageIdentifier, model
+
+from config import (
+    LANGID_CACHE_CONFIDENCE,
+    LANGID_CHECK_LENGTH,
+    LANGID_DEFAULT_LANGUAGE,
+    LANGID_MIN_CONFIDENCE,
+    LANGID_PREFIX_LENGTH,
+    WORKERS,
+)
+from memory import retrieval_memory
+from messages import new_message
 from ollama import ask_ollama_stream
+from persistence import chat_write_queue
 from speech import process_audio_file_common, save_speak_file
+from summary import conversation_summarizer
 
 
 def process_audio_file(file):
@@ -29,10 +41,12 @@ async def process_audio_file_async(file):
 
 
 async def process_audio_file_with_language(file, language=None):
-    user_input = await process_audio_file_common(file)
+    """
+    Process the audio file, recognizing speech in the requested language.
+    """
     if language:
-        return process_audio_file_common(user_input, language=language)
-    return user_input
+        return await process_audio_file_common(file, language=language)
+    return await process_audio_file_common(file)
 
 
 async def extract_user_input_async(file, text):
@@ -49,12 +63,58 @@ async def extract_user_input_async(file, text):
         )
 
 
-def detect_language(text: str) -> str:
+MAX_CACHED_CHANNEL_LANGUAGES = 10000
+
+language_identifier = None
+channel_languages: OrderedDict[str, str] = OrderedDict()
+
+
+def load_language_model():
+    """Load the langid model so the first request does not pay for it."""
+    global language_identifier
+    if language_identifier is None:
+        language_identifier = LanguageIdentifier.from_modelstring(
+            model, norm_probs=True
+        )
+    return language_identifier
+
+
+def detect_language(text: str, channel_id: str | None = None) -> str:
     """
     Detect the language of the given text using langid.
     Returns the language code (e.g., 'en', 'fr', etc.).
+
+    Only a prefix of the text is classified. Confident results are
+    remembered per channel; when a channel has a remembered language, a
+    shorter prefix is checked first and the full prefix is only classified
+    if the check disagrees, so a channel still follows the user when they
+    switch language. A detection below the minimum confidence falls back to
+    the channel's remembered language, or to the default language if the
+    channel has none.
     """
-    return langid.classify(text)[0]
+    identifier = load_language_model()
+    cached = channel_languages.get(channel_id) if channel_id else None
+    prefix = text[:LANGID_PREFIX_LENGTH]
+
+    if cached and LANGID_CHECK_LENGTH < len(prefix):
+        if identifier.classify(prefix[:LANGID_CHECK_LENGTH])[0] == cached:
+            channel_languages.move_to_end(channel_id)
+            return cached
+
+    lang, confidence = identifier.classify(prefix)
+
+    if confidence < LANGID_MIN_CONFIDENCE:
+        if cached:
+            channel_languages.move_to_end(channel_id)
+            return cached
+        return LANGID_DEFAULT_LANGUAGE
+
+    if channel_id and confidence >= LANGID_CACHE_CONFIDENCE:
+        channel_languages[channel_id] = lang
+        channel_languages.move_to_end(channel_id)
+        if len(channel_languages) > MAX_CACHED_CHANNEL_LANGUAGES:
+            channel_languages.popitem(last=False)
+    return lang
 
 
 async def extract_content_from_chunk(chunk) -> str:
@@ -65,32 +125,40 @@ async def extract_content_from_chunk(chunk) -> str:
     return ""
 
 
-async def stream_llm_response(model, chat_history) -> AsyncGenerator[str, None]:
-    async for chunk in ask_ollama_stream(model, chat_history):
+async def stream_llm_response(
+    model, chat_history, channel_id=None
+) -> AsyncGenerator[str, None]:
+    async for chunk in ask_ollama_stream(model, chat_history, channel_id):
         content = await extract_content_from_chunk(chunk)
         if content:
             yield content
 
 
 async def generate_audio_file(
-    response_text: str, language: str | None, request_id: str
+    response_text: str, language: str | None, request_id: str, channel_id=None
 ) -> str:
-    lang = language or detect_language(response_text)
+    lang = language or detect_language(response_text, channel_id)
     await save_speak_file(response_text, lang, request_id)
     return f"/static/audio/audio-{request_id}.mp3"
 
 
 def persist_chat_history(
-    session_id, channel_id, chat_history, response_text, audio_url
+    session_id, channel_id, user_input, response_text, audio_url, on_commit=None
 ):
-    chat_history.append(
-        {
-            "role": "ai",
-            "content": response_text,
-            "audio_url": audio_url,
-        }
+    """
+    Queue the user message and the AI response to be appended to the stored
+    history. The prompt history is not saved back, since it is truncated to
+    the context window and would drop older messages.
+    """
+    return chat_write_queue.enqueue(
+        session_id,
+        channel_id,
+        [
+            new_message("user", user_input),
+            new_message("ai", response_text, audio_url),
+        ],
+        on_commit,
     )
-    chat_storage_manager.save_chat_history(session_id, channel_id, chat_history)
 
 
 async def response_stream_generator(
@@ -102,6 +170,7 @@ async def response_stream_generator(
     chat_history,
     model,
     language=None,
+    stream_id=None,
 ) -> AsyncGenerator[str, None]:
     audio_request_id = str(uuid.uuid4())
     start_marker = "$[[START_JSON]]"
@@ -113,6 +182,9 @@ async def response_stream_generator(
         "channel_id": channel_id,
     }
 
+    if stream_id:
+        start_payload["stream_id"] = stream_id
+
     if is_file_uploaded:
         start_payload["resolved_text"] = user_input
 
@@ -128,7 +200,7 @@ async def response_stream_generator(
     )
 
     try:
-        async for content in stream_llm_response(model, chat_history):
+        async for content in stream_llm_response(model, chat_history, channel_id):
             accumulated_chunks.append(content)
             yield content
     except Exception:
@@ -144,7 +216,9 @@ async def response_stream_generator(
     audio_url = ""
 
     try:
-        audio_url = await generate_audio_file(response_text, language, audio_request_id)
+        audio_url = await generate_audio_file(
+            response_text, language, audio_request_id, channel_id
+        )
         audio_payload = json.dumps(
             {
                 "audio_url": audio_url,
@@ -155,13 +229,25 @@ async def response_stream_generator(
     except Exception:
         logging.exception("Audio generation failed")
 
-    persist_chat_history(
+    def on_commit():
+        conversation_summarizer.schedule(session_id, channel_id, model)
+        retrieval_memory.schedule(session_id, channel_id)
+
+    committed = persist_chat_history(
         session_id,
         channel_id,
-        chat_history,
+        user_input,
         response_text,
         audio_url,
+        on_commit,
     )
+    if WORKERS > 1:
+        # The next request may reach another worker, which cannot wait for
+        # this worker's queue, so the response ends only once it is stored.
+        try:
+            await committed
+        except Exception:
+            logging.exception("Failed to persist chat turn of %s", channel_id)
 
     logging.info(
         "Completed response pipeline for channel %s in %.2f seconds",
@@ -0,0 +1,170 @@
+"""
+This module streams chat channels to and from NDJSON archives. Each channel
+line is followed by its message lines; exports end with a stats line.
+Channels are read and written in batches so memory use does not grow with
+the size of the archive.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import AsyncGenerator
+
+import msgspec
+from fastapi import HTTPException, UploadFile
+
+from chat import chat_storage_manager
+from config import ARCHIVE_BATCH_SIZE
+from messages import (
+    ChannelRecord,
+    Message,
+    MessageRecord,
+    StatsRecord,
+    decode_history,
+    encode,
+    record_decoder,
+)
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_BATCH_MESSAGES = 5000
+
+
+async def export_ndjson(
+    user_id: str, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> AsyncGenerator[bytes, None]:
+    start_time = time.time()
+    channel_count = 0
+    message_count = 0
+    after_id = 0
+
+    while True:
+        rows = await asyncio.to_thread(
+            chat_storage_manager.export_channel_batch, user_id, after_id, batch_size
+        )
+        if not rows:
+            break
+        for row in rows:
+            after_id = row.id
+            channel_count += 1
+            lines = [
+                encode(
+                    ChannelRecord(
+                        row.channel_id,
+                        row.channel_name or "",
+                        row.created_at.isoformat() if row.created_at else "",
+                    )
+                )
+            ]
+            for message in decode_history(row.history):
+                lines.append(
+                    encode(
+                        MessageRecord(
+                            row.channel_id,
+                            message.role,
+                            message.content,
+                            message.audio_url,
+                            message.created_at,
+                        )
+                    )
+                )
+            message_count += len(lines) - 1
+            yield b"\n".join(lines) + b"\n"
+
+    seconds = time.time() - start_time
+    stats = StatsRecord(
+        channel_count,
+        message_count,
+        round(seconds, 3),
+        round(message_count / seconds, 1) if seconds else 0.0,
+    )
+    logging.info("Exported %s for user %s", stats, user_id)
+    yield encode(stats) + b"\n"
+
+
+async def read_lines(file: UploadFile) -> AsyncGenerator[bytes, None]:
+    buffer = b""
+    while chunk := await file.read(READ_CHUNK_SIZE):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def import_ndjson(
+    user_id: str, file: UploadFile, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> dict:
+    """
+    Import an NDJSON archive for a user. Channels are inserted in chunks of
+    batch_size, each in its own transaction; on an invalid line the chunks
+    before it stay imported.
+    """
+    start_time = time.time()
+    channel_count = 0
+    message_count = 0
+    batch: list[tuple[ChannelRecord, list[Message]]] = []
+    batch_messages = 0
+    current = None
+
+    async def write_batch():
+        nonlocal batch, batch_messages
+        if batch:
+            await asyncio.to_thread(
+                chat_storage_manager.import_channels, user_id, batch
+            )
+            batch = []
+            batch_messages = 0
+
+    line_number = 0
+    async for line in read_lines(file):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = record_decoder.decode(line)
+        except msgspec.DecodeError as e:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid archive line {line_number}: {e}"
+            ) from e
+
+        if isinstance(record, ChannelRecord):
+            if record.created_at:
+                try:
+                    datetime.fromisoformat(record.created_at)
+                except ValueError as e:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Invalid archive line {line_number}: {e}",
+                    ) from e
+            if len(batch) >= batch_size or batch_messages >= MAX_BATCH_MESSAGES:
+                await write_batch()
+            current = (record, [])
+            batch.append(current)
+            channel_count += 1
+        elif isinstance(record, MessageRecord):
+            if current is None or current[0].channel_id != record.channel_id:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Message on line {line_number} does not follow its channel",
+                )
+            current[1].append(
+                Message(
+                    record.role, record.content, record.audio_url, record.created_at
+                )
+            )
+            message_count += 1
+            batch_messages += 1
+
+    await write_batch()
+
+    seconds = time.time() - start_time
+    stats = {
+        "channels": channel_count,
+        "messages": message_count,
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(message_count / seconds, 1) if seconds else 0.0,
+    }
+    logging.info("Imported %s for user %s", stats, user_id)
+    return stats
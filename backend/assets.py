@@ -0,0 +1,282 @@
+"""
+This module serves static files from memory. Files are read on first
+request, or at startup for preloaded directories, together with gzip and
+brotli variants, and are re-read when their modification time changes.
+Conditional requests are answered from the cached ETag without touching
+the disk.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi import HTTPException
+from fastapi.datastructures import Headers
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+
+from config import (
+    STATIC_CACHE_CHECK_INTERVAL,
+    STATIC_CACHE_MAX_FILE_SIZE,
+    STATIC_CACHE_SIZE,
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REVALIDATE_CACHE_CONTROL = "no-cache"
+MIN_COMPRESS_SIZE = 1024
+MAX_LOOKUPS = 4096
+COMPRESSIBLE_TYPES = (
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+    "image/x-icon",
+    "image/vnd.microsoft.icon",
+)
+
+
+def is_compressible(media_type: str) -> bool:
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+class Asset:
+    """A file held in memory with its precompressed variants."""
+
+    __slots__ = (
+        "path",
+        "mtime_ns",
+        "size",
+        "media_type",
+        "etag",
+        "variants",
+        "checked_at",
+    )
+
+    def __init__(self, path: Path, mtime_ns: int, size: int, body: bytes):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.media_type = (
+            mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        )
+        self.etag = hashlib.md5(body, usedforsecurity=False).hexdigest()
+        self.variants = {"identity": body}
+        if len(body) >= MIN_COMPRESS_SIZE and is_compressible(self.media_type):
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.variants["br"] = compressed
+        self.checked_at = time.monotonic()
+
+    @property
+    def memory_size(self) -> int:
+        return sum(len(body) for body in self.variants.values())
+
+    def etags(self) -> set[str]:
+        return {f'"{self.etag}-{encoding}"' for encoding in self.variants}
+
+    def select_encoding(self, accept_encoding: str) -> str:
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.partition(";")
+            try:
+                if float(params.strip().removeprefix("q=") or 1) <= 0:
+                    continue
+            except ValueError:
+                pass
+            accepted.add(name.strip())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+def load_asset(path: Path) -> Asset | None:
+    """Read a file into an Asset, or return None if it is too large to cache."""
+    stat = path.stat()
+    if stat.st_size > STATIC_CACHE_MAX_FILE_SIZE:
+        return None
+    body = path.read_bytes()
+    return Asset(path, stat.st_mtime_ns, stat.st_size, body)
+
+
+class AssetCache:
+    """
+    Least recently used cache of assets by absolute path, bounded by the
+    total size of all variants. Cached files are checked for changes at most
+    once per check_interval seconds.
+    """
+
+    def __init__(
+        self,
+        max_size: int = STATIC_CACHE_SIZE,
+        check_interval: float = STATIC_CACHE_CHECK_INTERVAL,
+    ):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.assets: OrderedDict[Path, Asset] = OrderedDict()
+        self.size = 0
+
+    def fresh(self, path: Path) -> Asset | None:
+        """Return the cached asset if it was checked recently, without I/O."""
+        asset = self.assets.get(path)
+        if asset is None or time.monotonic() - asset.checked_at > self.check_interval:
+            return None
+        self.assets.move_to_end(path)
+        return asset
+
+    def revalidate(self, path: Path) -> Asset | None:
+        """Stat a cached file and return it if unchanged."""
+        asset = self.assets.get(path)
+        if asset is None:
+            return None
+        try:
+            stat = path.stat()
+        except OSError:
+            self.remove(path)
+            return None
+        if stat.st_mtime_ns != asset.mtime_ns or stat.st_size != asset.size:
+            return None
+        asset.checked_at = time.monotonic()
+        self.assets.move_to_end(path)
+        return asset
+
+    def store(self, asset: Asset):
+        self.remove(asset.path)
+        if asset.memory_size > self.max_size:
+            return
+        self.assets[asset.path] = asset
+        self.size += asset.memory_size
+        while self.size > self.max_size:
+            _, evicted = self.assets.popitem(last=False)
+            self.size -= evicted.memory_size
+
+    def remove(self, path: Path):
+        asset = self.assets.pop(path, None)
+        if asset is not None:
+            self.size -= asset.memory_size
+
+    async def get(self, path: Path) -> Asset | None:
+        """
+        Return the asset for a file, reading it in a worker thread if it is
+        not cached or has changed. Returns None for files that are too large
+        to cache.
+        """
+        asset = self.fresh(path) or self.revalidate(path)
+        if asset is not None:
+            return asset
+        try:
+            asset = await asyncio.to_thread(load_asset, path)
+        except OSError:
+            self.remove(path)
+            raise HTTPException(status_code=404)
+        if asset is not None:
+            self.store(asset)
+        return asset
+
+    def preload(self, directory: Path):
+        """Load every cacheable file under a directory, for use at startup."""
+        count = 0
+        for path in directory.rglob("*"):
+            if not path.is_file():
+                continue
+            try:
+                asset = load_asset(path.resolve())
+            except OSError:
+                logging.exception("Failed to preload %s", path)
+                continue
+            if asset is not None:
+                self.store(asset)
+                count += 1
+        logging.info("Preloaded %d static files from %s", count, directory)
+
+    def response(self, asset: Asset, headers: Headers, cache_control: str) -> Response:
+        encoding = asset.select_encoding(headers.get("accept-encoding", ""))
+        response_headers = {
+            "ETag": f'"{asset.etag}-{encoding}"',
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & asset.etags():
+                return Response(status_code=304, headers=response_headers)
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(
+            asset.variants[encoding],
+            media_type=asset.media_type,
+            headers=response_headers,
+        )
+
+
+asset_cache = AssetCache()
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    Serves files from the first of several directories that contains them,
+    through the asset cache. Lookups, including misses, are remembered for
+    the cache check interval so repeated requests do not stat the
+    directories. Range requests and files too large to cache are served
+    from disk.
+    """
+
+    def __init__(
+        self,
+        *directories: Path,
+        cache: AssetCache = asset_cache,
+    ):
+        super().__init__(directory=directories[0], check_dir=False)
+        self.directories = [directory.resolve() for directory in directories]
+        self.cache = cache
+        self.lookups: dict[str, tuple[Path | None, float]] = {}
+
+    def resolve(self, path: str) -> Path | None:
+        now = time.monotonic()
+        cached = self.lookups.get(path)
+        if cached is not None and now - cached[1] <= self.cache.check_interval:
+            return cached[0]
+        found = None
+        for directory in self.directories:
+            candidate = (directory / path).resolve()
+            if candidate.is_relative_to(directory) and candidate.is_file():
+                found = candidate
+                break
+        if len(self.lookups) >= MAX_LOOKUPS:
+            self.lookups.clear()
+        self.lookups[path] = (found, now)
+        return found
+
+    async def get_response(self, path: str, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        file_path = self.resolve(path)
+        if file_path is None:
+            raise HTTPException(status_code=404)
+        return await serve_file(file_path, Headers(scope=scope), cache=self.cache)
+
+
+async def serve_file(
+    path: Path,
+    headers: Headers,
+    cache_control: str = REVALIDATE_CACHE_CONTROL,
+    cache: AssetCache = asset_cache,
+) -> Response:
+    asset = None if "range" in headers else await cache.get(path)
+    if asset is None:
+        return FileResponse(path, headers={"Cache-Control": cache_control})
+    return cache.response(asset, headers, cache_control)
@@ -1,26 +1,40 @@
-import json
+import hashlib
+import html
 import logging
 import os
 import re
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
 
 import nltk
 from fastapi import HTTPException
 from sqlalchemy import (
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Integer,
+    LargeBinary,
     String,
     Text,
     create_engine,
+    event,
+    text,
 )
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from sqlalchemy.sql import func
 
+from config import DB_BUSY_TIMEOUT, MAX_CONTEXT_LENGTH
+from messages import Message, decode, decode_history, encode, encode_history
+
 nltk.download("punkt_tab")
 
 MAX_HISTORY_LENGTH = 10000
-MAX_CONTEXT_LENGTH = 3000
+INDEX_PURGE_INTERVAL = 256
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
 
 Base = declarative_base()
 
@@ -31,10 +45,50 @@ DATABASE_URL = f"sqlite:///{DATABASE_FOLDER}/{DATABASE_FILE}"
 os.makedirs(DATABASE_FOLDER, exist_ok=True)
 
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT},
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+@event.listens_for(engine, "connect")
+def configure_connection(dbapi_connection, connection_record):
+    """
+    Use WAL so readers in other workers do not block the writer, and let
+    SQLAlchemy emit BEGIN itself so write transactions can lock up front.
+    """
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+@event.listens_for(engine, "begin")
+def begin_transaction(connection):
+    if connection.get_execution_options().get("immediate"):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        connection.exec_driver_sql("BEGIN")
+
+
+@contextmanager
+def open_session(write: bool = False):
+    """
+    Open a session for one operation. Write sessions take the database lock
+    when they begin, so a read-modify-write cannot interleave with a write
+    from another worker process.
+    """
+    db = SessionLocal()
+    try:
+        if write:
+            db.connection(execution_options={"immediate": True})
+        yield db
+    finally:
+        db.close()
+
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -53,8 +107,89 @@ class Channel(Base):
     created_at = Column(DateTime, default=func.now())
 
 
+class ChannelSummary(Base):
+    """Rolling summary of the oldest messages of a channel."""
+
+    __tablename__ = "channel_summaries"
+    channel_id = Column(String, primary_key=True)
+    summary = Column(Text)
+    summarized_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class MessageEmbedding(Base):
+    """Embedding vector of a stored message, used for retrieval memory."""
+
+    __tablename__ = "message_embeddings"
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String, index=True)
+    position = Column(Integer)
+    role = Column(String)
+    content = Column(Text)
+    embedding = Column(LargeBinary)
+
+
+class SearchIndexState(Base):
+    """Tracks how much of a channel's history is in the full-text index."""
+
+    __tablename__ = "search_index_state"
+    channel_id = Column(String, primary_key=True)
+    indexed_count = Column(Integer, default=0)
+    indexed_digest = Column(String)
+    start_offset = Column(Integer, default=0)
+    purged_offset = Column(Integer, default=0)
+
+
+class SharedState(Base):
+    """JSON state shared between worker processes, such as Ollama host health."""
+
+    __tablename__ = "shared_state"
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+    updated_at = Column(Float)
+
+
 Base.metadata.create_all(bind=engine)
 
+with engine.begin() as connection:
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+            "content, user_key, channel_key, position UNINDEXED, role UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+
+
+def fts_phrase(value: str) -> str:
+    """Quote a value as an FTS5 phrase so user input cannot inject syntax."""
+    return '"' + value.replace('"', '""') + '"'
+
+
+def search_match(user_id: str, terms: list[str]) -> str:
+    """FTS5 query matching messages of a user that contain all terms."""
+    return (
+        f"user_key : {fts_phrase(user_id)} AND content : ("
+        + " ".join(fts_phrase(term) for term in terms)
+        + ")"
+    )
+
+
+def highlight_snippet(snippet: str) -> str:
+    """
+    HTML-escape a snippet of message text and turn its match delimiters
+    into <mark> tags, so it is safe to render as HTML.
+    """
+    return (
+        html.escape(snippet)
+        .replace(SNIPPET_OPEN, "<mark>")
+        .replace(SNIPPET_CLOSE, "</mark>")
+    )
+
+
+def history_digest(history: list[Message]) -> str:
+    return hashlib.sha1(encode(history)).hexdigest()
+
 
 class ChatStorageManager:
     """
@@ -62,164 +197,522 @@ class ChatStorageManager:
     saving and loading chat history, and deleting channels.
     """
 
-    def __init__(self):
-        self.db = SessionLocal()
-
     def create_user(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
+        with open_session(write=True) as db:
+            user = self._get_or_create_user(db, user_id)
+            db.commit()
+            db.refresh(user)
+            return user
+
+    def _get_or_create_user(self, db, user_id: str):
+        user = db.query(User).filter(User.user_id == user_id).first()
         if not user:
             user = User(user_id=user_id)
-            self.db.add(user)
-            self.db.commit()
-            self.db.refresh(user)
+            db.add(user)
+            db.flush()
         return user
 
-    def create_channel(self, user_id: str, channel_id: str, text: str):
-        user = self.create_user(user_id)
-        channel = (
-            self.db.query(Channel).filter(Channel.channel_id == channel_id).first()
+    def _get_channel(self, db, user_id: str, channel_id: str):
+        return (
+            db.query(Channel)
+            .join(User, Channel.user_id == User.id)
+            .filter(User.user_id == user_id, Channel.channel_id == channel_id)
+            .first()
         )
 
-        if channel:
-            raise HTTPException(status_code=400, detail="Channel already exists")
-
-        channel_name = generate_summary_title(text)
-        channel = Channel(
-            channel_id=channel_id,
-            channel_name=channel_name,
-            user_id=user.id,
-            history="[]",
-        )
-        self.db.add(channel)
-        self.db.commit()
-        self.db.refresh(channel)
-        return channel
+    def create_channel(self, user_id: str, channel_id: str, text: str):
+        with open_session(write=True) as db:
+            user = self._get_or_create_user(db, user_id)
+            channel = db.query(Channel).filter(Channel.channel_id == channel_id).first()
+
+            if channel:
+                raise HTTPException(status_code=400, detail="Channel already exists")
+
+            channel_name = generate_summary_title(text)
+            channel = Channel(
+                channel_id=channel_id,
+                channel_name=channel_name,
+                user_id=user.id,
+                history="[]",
+            )
+            db.add(channel)
+            db.commit()
+            db.refresh(channel)
+            return channel
 
     def get_channels(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return []
-
-        channels = (
-            self.db.query(Channel)
-            .filter(Channel.user_id == user.id)
-            .order_by(Channel.created_at.desc())
-            .all()
-        )
+        with open_session() as db:
+            channels = (
+                db.query(Channel.channel_id, Channel.channel_name)
+                .join(User, Channel.user_id == User.id)
+                .filter(User.user_id == user_id)
+                .order_by(Channel.created_at.desc())
+                .all()
+            )
         return [
             {"id": channel.channel_id, "name": channel.channel_name}
             for channel in channels
         ]
 
     def does_channel_exist(self, user_id: str, channel_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return False
-
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
-        )
-        return channel is not None
+        with open_session() as db:
+            return self._get_channel(db, user_id, channel_id) is not None
 
     def save_chat_history(self, user_id: str, channel_id: str, history):
+        with open_session(write=True) as db:
+            self._update_chat_history(db, user_id, channel_id, history)
+            db.commit()
+
+    def _update_chat_history(self, db, user_id: str, channel_id: str, history):
+        """Write the history to the session without committing."""
         logging.info(
-            f"Saving chat history for channel {channel_id}. {history} for user {user_id}"
+            "Saving chat history for channel %s (%d messages) for user %s",
+            channel_id,
+            len(history) if isinstance(history, list) else 0,
+            user_id,
         )
         if not isinstance(history, list):
             raise HTTPException(status_code=400, detail="History must be a list")
 
-        user = self.db.query(User).filter(User.user_id == user_id).first()
+        user = db.query(User).filter(User.user_id == user_id).first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
         channel = (
-            self.db.query(Channel)
+            db.query(Channel)
             .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
             .first()
         )
         if not channel:
             raise HTTPException(status_code=404, detail="Channel not found")
 
-        if len(history) > MAX_HISTORY_LENGTH:
-            history = history[-MAX_HISTORY_LENGTH:]
+        dropped = max(0, len(history) - MAX_HISTORY_LENGTH)
+        channel.history = encode_history(history[dropped:])
+        self._index_channel_history(db, user_id, channel_id, history, dropped)
 
-        channel.history = json.dumps(history)
-        self.db.commit()
-        result = self.load_chat_history(user_id, channel_id)
-        print(f"Saved chat history: {result}")
+    def append_chat_messages(self, user_id: str, channel_id: str, messages):
+        """Append messages to the stored history of a channel."""
+        self.append_chat_turns([(user_id, channel_id, messages)])
 
-    def load_chat_history(
-        self, user_id: str, channel_id: str, is_llm_call: bool = False
+    def append_chat_turns(self, turns):
+        """
+        Append the messages of several (user_id, channel_id, messages) turns
+        in a single transaction, in order. Turns whose channel no longer
+        exists are dropped.
+        """
+        with open_session(write=True) as db:
+            histories = {}
+            for user_id, channel_id, messages in turns:
+                key = (user_id, channel_id)
+                if key not in histories:
+                    histories[key] = self._load_chat_history(db, user_id, channel_id)
+                histories[key].extend(messages)
+
+            for (user_id, channel_id), history in histories.items():
+                try:
+                    self._update_chat_history(db, user_id, channel_id, history)
+                except HTTPException as e:
+                    logging.error(
+                        "Dropping messages for channel %s: %s", channel_id, e.detail
+                    )
+            db.commit()
+
+    def get_channel_summary(self, channel_id: str):
+        with open_session() as db:
+            return db.get(ChannelSummary, channel_id)
+
+    def save_channel_summary(
+        self, channel_id: str, summary: str, summarized_count: int
     ):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return []
+        with open_session(write=True) as db:
+            channel_summary = db.get(ChannelSummary, channel_id)
+            if not channel_summary:
+                channel_summary = ChannelSummary(channel_id=channel_id)
+                db.add(channel_summary)
+            channel_summary.summary = summary
+            channel_summary.summarized_count = summarized_count
+            db.commit()
+
+    def load_message_embeddings(self, channel_id: str, start_position: int = 0):
+        with open_session() as db:
+            return (
+                db.query(MessageEmbedding)
+                .filter(
+                    MessageEmbedding.channel_id == channel_id,
+                    MessageEmbedding.position >= start_position,
+                )
+                .order_by(MessageEmbedding.position)
+                .all()
+            )
 
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
+    def count_embedded_messages(self, channel_id: str) -> int:
+        with open_session() as db:
+            return self._count_embedded_messages(db, channel_id)
+
+    def _count_embedded_messages(self, db, channel_id: str) -> int:
+        last = (
+            db.query(func.max(MessageEmbedding.position))
+            .filter(MessageEmbedding.channel_id == channel_id)
+            .scalar()
         )
-        if not channel:
-            return []
+        return 0 if last is None else last + 1
 
-        full_history = json.loads(channel.history)
+    def save_message_embeddings(self, channel_id: str, rows):
+        """
+        Store (position, role, content, embedding bytes) rows. Rows another
+        worker already stored are skipped.
+        """
+        with open_session(write=True) as db:
+            start = self._count_embedded_messages(db, channel_id)
+            db.add_all(
+                MessageEmbedding(
+                    channel_id=channel_id,
+                    position=position,
+                    role=role,
+                    content=content,
+                    embedding=embedding,
+                )
+                for position, role, content, embedding in rows
+                if position >= start
+            )
+            db.commit()
+
+    def load_chat_history(
+        self, user_id: str, channel_id: str, is_llm_call: bool = False
+    ):
+        with open_session() as db:
+            full_history = self._load_chat_history(db, user_id, channel_id)
 
         if is_llm_call:
-            filtered_history = []
-            for message in full_history:
-                filtered_message = {
-                    k: v for k, v in message.items() if k != "audio_url"
-                }
-                filtered_history.append(filtered_message)
-            truncated = self._truncate_history_by_character_length(
-                filtered_history, MAX_CONTEXT_LENGTH
-            )
-            return truncated
+            return self.truncate_context(full_history)
 
         return full_history
 
-    def delete_channel(self, user_id: str, channel_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+    def truncate_context(self, history, max_characters: int = MAX_CONTEXT_LENGTH):
+        """The most recent messages of a history that fit in the LLM context."""
+        return self._truncate_history_by_character_length(history, max_characters)
 
-        channel = (
-            self.db.query(Channel)
-            .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
-            .first()
-        )
+    def load_chat_history_window(self, user_id: str, channel_id: str):
+        """
+        Return the stored history and the position of its first message,
+        which stays the same when older messages are trimmed.
+        """
+        with open_session() as db:
+            history = self._load_chat_history(db, user_id, channel_id)
+            state = db.get(SearchIndexState, channel_id)
+            return history, state.start_offset if state else 0
+
+    def _load_chat_history(self, db, user_id: str, channel_id: str):
+        channel = self._get_channel(db, user_id, channel_id)
         if not channel:
-            raise HTTPException(status_code=404, detail="Channel not found")
+            return []
+        return decode_history(channel.history)
 
-        self.db.delete(channel)
-        self.db.commit()
+    def delete_channel(self, user_id: str, channel_id: str):
+        with open_session(write=True) as db:
+            user = db.query(User).filter(User.user_id == user_id).first()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            channel = (
+                db.query(Channel)
+                .filter(Channel.channel_id == channel_id, Channel.user_id == user.id)
+                .first()
+            )
+            if not channel:
+                raise HTTPException(status_code=404, detail="Channel not found")
+
+            self._remove_channel_from_index(db, channel_id)
+            db.query(ChannelSummary).filter(
+                ChannelSummary.channel_id == channel_id
+            ).delete()
+            db.query(MessageEmbedding).filter(
+                MessageEmbedding.channel_id == channel_id
+            ).delete()
+            db.delete(channel)
+            db.commit()
 
     def delete_all_channels(self, user_id: str):
-        user = self.db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        with open_session(write=True) as db:
+            user = db.query(User).filter(User.user_id == user_id).first()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            channel_ids = [
+                row.channel_id
+                for row in db.query(Channel.channel_id).filter(
+                    Channel.user_id == user.id
+                )
+            ]
+            for channel_id in channel_ids:
+                self._remove_channel_from_index(db, channel_id)
+            db.query(ChannelSummary).filter(
+                ChannelSummary.channel_id.in_(channel_ids)
+            ).delete()
+            db.query(MessageEmbedding).filter(
+                MessageEmbedding.channel_id.in_(channel_ids)
+            ).delete()
+            db.query(Channel).filter(Channel.user_id == user.id).delete()
+            db.commit()
+
+    def search(self, user_id: str, query: str, limit: int = 20):
+        """
+        Full-text search over a user's messages, ranked by relevance.
+        Returns the channel, message position and a highlighted snippet.
+        """
+        terms = query.split()
+        if not user_id or not terms:
+            return []
+
+        with open_session() as db:
+            rows = db.execute(
+                text(
+                    "SELECT s.channel_key, s.position - COALESCE(st.start_offset, 0) "
+                    "AS position, s.role, "
+                    "snippet(message_search, 0, :open, :close, '...', 16) "
+                    "AS snippet, c.channel_name "
+                    "FROM message_search AS s "
+                    "JOIN channels AS c ON c.channel_id = s.channel_key "
+                    "LEFT JOIN search_index_state AS st "
+                    "ON st.channel_id = s.channel_key "
+                    "WHERE message_search MATCH :match AND s.user_key = :user_id "
+                    "AND s.position >= COALESCE(st.start_offset, 0) "
+                    "ORDER BY bm25(message_search, 1.0, 0.0, 0.0) "
+                    "LIMIT :limit"
+                ),
+                {
+                    "match": search_match(user_id, terms),
+                    "user_id": user_id,
+                    "limit": limit,
+                    "open": SNIPPET_OPEN,
+                    "close": SNIPPET_CLOSE,
+                },
+            ).all()
+        return [
+            {
+                "channel_id": row.channel_key,
+                "channel_name": row.channel_name,
+                "position": row.position,
+                "role": row.role,
+                "snippet": highlight_snippet(row.snippet),
+            }
+            for row in rows
+        ]
+
+    def get_shared_state(self, key: str, max_age: float):
+        """Return the decoded value of a shared state key if recently updated."""
+        with open_session() as db:
+            state = db.get(SharedState, key)
+        if state is None or time.time() - state.updated_at > max_age:
+            return None
+        return decode(state.value)
+
+    def set_shared_state(self, key: str, value):
+        with open_session(write=True) as db:
+            state = db.get(SharedState, key)
+            if state is None:
+                state = SharedState(key=key)
+                db.add(state)
+            state.value = encode(value).decode("utf-8")
+            state.updated_at = time.time()
+            db.commit()
+
+    def backfill_search_index(self, batch_size: int = 100):
+        """Index the history of channels saved before search existed."""
+        indexed = 0
+        while True:
+            with open_session(write=True) as db:
+                rows = (
+                    db.query(Channel.channel_id, Channel.history, User.user_id)
+                    .join(User, Channel.user_id == User.id)
+                    .outerjoin(
+                        SearchIndexState,
+                        SearchIndexState.channel_id == Channel.channel_id,
+                    )
+                    .filter(SearchIndexState.channel_id.is_(None))
+                    .limit(batch_size)
+                    .all()
+                )
+                if not rows:
+                    break
+                for channel_id, history, user_id in rows:
+                    self._index_channel_history(
+                        db, user_id, channel_id, decode_history(history)
+                    )
+                db.commit()
+            indexed += len(rows)
+        if indexed:
+            logging.info("Backfilled search index for %d channels", indexed)
+        return indexed
+
+    def export_channel_batch(self, user_id: str, after_id: int = 0, limit: int = 50):
+        """
+        Return the next batch of a user's channels with an id above after_id.
+        """
+        with open_session() as db:
+            return (
+                db.query(
+                    Channel.id,
+                    Channel.channel_id,
+                    Channel.channel_name,
+                    Channel.created_at,
+                    Channel.history,
+                )
+                .join(User, Channel.user_id == User.id)
+                .filter(User.user_id == user_id, Channel.id > after_id)
+                .order_by(Channel.id)
+                .limit(limit)
+                .all()
+            )
+
+    def import_channels(self, user_id: str, channels):
+        """
+        Insert (ChannelRecord, messages) pairs for a user in one transaction.
+        Channel ids that already exist are replaced with new ones.
+        """
+        with open_session(write=True) as db:
+            user = self._get_or_create_user(db, user_id)
+
+            ids = [record.channel_id for record, _ in channels]
+            taken = {
+                row.channel_id
+                for row in db.query(Channel.channel_id).filter(
+                    Channel.channel_id.in_(ids)
+                )
+            }
+            for record, messages in channels:
+                channel_id = record.channel_id
+                if channel_id in taken or not channel_id:
+                    channel_id = str(uuid.uuid4())
+                taken.add(channel_id)
+
+                history = messages[-MAX_HISTORY_LENGTH:]
+                channel = Channel(
+                    channel_id=channel_id,
+                    channel_name=record.channel_name,
+                    user_id=user.id,
+                    history=encode_history(history),
+                )
+                if record.created_at:
+                    channel.created_at = datetime.fromisoformat(record.created_at)
+                db.add(channel)
+                self._index_channel_history(db, user_id, channel_id, history)
+            db.commit()
+
+    def _index_channel_history(
+        self, db, user_id: str, channel_id: str, history, dropped: int = 0
+    ):
+        """
+        Bring the full-text index in line with the channel history, of which
+        the first dropped messages are trimmed before it is stored. New
+        messages appended to an already indexed history are inserted
+        incrementally; any other change reindexes the channel.
+
+        Indexed positions count from the first message ever indexed, and
+        start_offset is the position of the first stored message, so
+        trimming the oldest messages does not renumber the rest. A reindexed
+        history is numbered after the old one, so positions only grow and
+        retrieval memory can use them to find messages it has not embedded.
+        Rows of trimmed messages are skipped by search and purged in batches.
+        """
+        state = db.get(SearchIndexState, channel_id)
+        start = 0
+        offset = 0
+        if state:
+            offset = state.start_offset or 0
+            if (
+                len(history) >= state.indexed_count
+                and history_digest(history[: state.indexed_count])
+                == state.indexed_digest
+            ):
+                start = state.indexed_count
+            else:
+                self._remove_channel_from_index(db, channel_id, keep_state=True)
+                offset += state.indexed_count
+                state.purged_offset = offset
+
+        rows = [
+            {
+                "content": message.content,
+                "user_key": user_id,
+                "channel_key": channel_id,
+                "position": offset + index,
+                "role": message.role,
+            }
+            for index, message in enumerate(history[start:], start)
+            if index >= dropped and message.role != "system" and message.content
+        ]
+        if rows:
+            db.execute(
+                text(
+                    "INSERT INTO message_search "
+                    "(content, user_key, channel_key, position, role) "
+                    "VALUES (:content, :user_key, :channel_key, :position, :role)"
+                ),
+                rows,
+            )
 
-        self.db.query(Channel).filter(Channel.user_id == user.id).delete()
-        self.db.commit()
+        if not state:
+            state = SearchIndexState(channel_id=channel_id, purged_offset=0)
+            db.add(state)
+        stored = history[dropped:]
+        state.start_offset = offset + dropped
+        state.indexed_count = len(stored)
+        state.indexed_digest = history_digest(stored)
+        if state.start_offset - (state.purged_offset or 0) >= INDEX_PURGE_INTERVAL:
+            db.execute(
+                text(
+                    "DELETE FROM message_search WHERE rowid IN ("
+                    "SELECT rowid FROM message_search "
+                    "WHERE message_search MATCH :match AND channel_key = :channel_id "
+                    "AND position < :start_offset)"
+                ),
+                {
+                    "match": f"channel_key : {fts_phrase(channel_id)}",
+                    "channel_id": channel_id,
+                    "start_offset": state.start_offset,
+                },
+            )
+            state.purged_offset = state.start_offset
+
+    def _remove_channel_from_index(self, db, channel_id: str, keep_state=False):
+        db.execute(
+            text(
+                "DELETE FROM message_search WHERE rowid IN ("
+                "SELECT rowid FROM message_search "
+                "WHERE message_search MATCH :match AND channel_key = :channel_id)"
+            ),
+            {
+                "match": f"channel_key : {fts_phrase(channel_id)}",
+                "channel_id": channel_id,
+            },
+        )
+        if not keep_state:
+            db.query(SearchIndexState).filter(
+                SearchIndexState.channel_id == channel_id
+            ).delete()
 
     def _truncate_history_by_character_length(self, history, max_characters):
         """
         Truncates the chat history to ensure the total character count is within the specified limit.
+        The latest turn, from the last user message on, is always kept.
         """
+        latest_turn = next(
+            (i for i in reversed(range(len(history))) if history[i].role == "user"),
+            len(history) - 1,
+        )
+
         total_characters = 0
-        truncated_history = []
+        start = len(history)
 
-        for message in reversed(history):
-            message_length = len(message)
+        while start > 0:
+            message_length = len(history[start - 1].content)
             if total_characters + message_length > max_characters:
                 break
-            truncated_history.insert(0, message)
+            start -= 1
             total_characters += message_length
 
-        return truncated_history
+        return history[min(start, max(latest_turn, 0)) :]
 
 
 def generate_summary_title(text, max_length=40):
@@ -10,6 +10,11 @@ host = os.getenv("HOST", "http://localhost")
 port = os.getenv("PORT", "8000")
 
 ollama_host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+ollama_hosts = [
+    url.strip().rstrip("/")
+    for url in os.getenv("OLLAMA_HOSTS", ollama_host).split(",")
+    if url.strip()
+]
 
 ollama_url = f"{ollama_host}/api/chat"
 ollama_tags_url = os.getenv("OLLAMA_TAGS_URL", f"{ollama_host}/api/tags")
@@ -17,3 +22,74 @@ ollama_tags_url = os.getenv("OLLAMA_TAGS_URL", f"{ollama_host}/api/tags")
 SYSTEM_MESSAGE = os.getenv(
     "SYSTEM_MESSAGE", "You are yukigpt, a chatbot. Be Helpful to user."
 )
+
+
+def parse_mapping(value: str) -> dict[str, str]:
+    """Parse a 'key=value,key=value' environment string into a dict."""
+    mapping = {}
+    for item in value.split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            mapping[key.strip()] = val.strip()
+    return mapping
+
+
+STT_ENGINE = os.getenv("STT_ENGINE", "google")
+STT_WORKERS = int(os.getenv("STT_WORKERS", "2"))
+STT_MODELS = parse_mapping(os.getenv("STT_MODELS", ""))
+
+TTS_ENGINES = [
+    name.strip() for name in os.getenv("TTS_ENGINES", "edge").split(",") if name.strip()
+]
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "60"))
+TTS_LATENCY_BUDGET = float(os.getenv("TTS_LATENCY_BUDGET", "15"))
+TTS_ENGINE_COOLDOWN = float(os.getenv("TTS_ENGINE_COOLDOWN", "60"))
+TTS_MAX_LENGTH = int(os.getenv("TTS_MAX_LENGTH", "100000"))
+TTS_CHUNK_SIZE = int(os.getenv("TTS_CHUNK_SIZE", "1000"))
+TTS_CHUNK_PARALLELISM = int(os.getenv("TTS_CHUNK_PARALLELISM", "4"))
+EDGE_TTS_VOICES = parse_mapping(os.getenv("EDGE_TTS_VOICES", ""))
+PIPER_VOICES = parse_mapping(os.getenv("PIPER_VOICES", ""))
+ESPEAK_VOICES = parse_mapping(os.getenv("ESPEAK_VOICES", ""))
+
+LANGID_PREFIX_LENGTH = int(os.getenv("LANGID_PREFIX_LENGTH", "500"))
+LANGID_CHECK_LENGTH = int(os.getenv("LANGID_CHECK_LENGTH", "100"))
+LANGID_MIN_CONFIDENCE = float(os.getenv("LANGID_MIN_CONFIDENCE", "0"))
+LANGID_CACHE_CONFIDENCE = float(os.getenv("LANGID_CACHE_CONFIDENCE", "0.9"))
+LANGID_DEFAULT_LANGUAGE = os.getenv("LANGID_DEFAULT_LANGUAGE", "en")
+
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "30"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "10"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "120"))
+
+MAX_CONTEXT_LENGTH = int(os.getenv("MAX_CONTEXT_LENGTH", "3000"))
+SUMMARY_REFRESH_TURNS = int(os.getenv("SUMMARY_REFRESH_TURNS", "4"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "")
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.3"))
+
+STREAM_DISCONNECT_POLICY = os.getenv("STREAM_DISCONNECT_POLICY", "finish")
+STREAM_BUFFER_LIMIT = int(os.getenv("STREAM_BUFFER_LIMIT", str(1024 * 1024)))
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "10"))
+STREAM_TTL = float(os.getenv("STREAM_TTL", "300"))
+STREAM_MAX_STREAMS = int(os.getenv("STREAM_MAX_STREAMS", "100"))
+
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.05"))
+
+STATIC_CACHE_SIZE = int(os.getenv("STATIC_CACHE_SIZE", str(64 * 1024 * 1024)))
+STATIC_CACHE_MAX_FILE_SIZE = int(
+    os.getenv("STATIC_CACHE_MAX_FILE_SIZE", str(4 * 1024 * 1024))
+)
+STATIC_CACHE_CHECK_INTERVAL = float(os.getenv("STATIC_CACHE_CHECK_INTERVAL", "2"))
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "")
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", "20"))
+DIAGNOSTICS_TOKEN = os.getenv("DIAGNOSTICS_TOKEN", "")
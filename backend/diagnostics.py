@@ -0,0 +1,292 @@
+"""
+This module finds where the event loop spends its time. A lag monitor logs
+the stack of callbacks that block the loop, and sampled requests can be
+profiled with cProfile and read back from the diagnostics endpoints, which
+need the diagnostics token or, without one, a local client.
+"""
+
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import marshal
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+from fastapi import HTTPException, Request
+
+from config import (
+    DIAGNOSTICS_TOKEN,
+    LOOP_LAG_THRESHOLD,
+    PROFILE_HEADER,
+    PROFILE_HISTORY,
+    PROFILE_SAMPLE_RATE,
+)
+
+MAX_RECORDED_STALLS = 50
+LOCAL_HOSTS = ("127.0.0.1", "::1")
+
+
+def token_matches(supplied: str | None, token: str) -> bool:
+    return bool(token) and hmac.compare_digest(
+        (supplied or "").encode(), token.encode()
+    )
+
+
+def has_diagnostics_access(request: Request) -> bool:
+    """
+    Requests need the diagnostics token as a bearer token, or, when no token
+    is configured, must come from the local machine.
+    """
+    if DIAGNOSTICS_TOKEN:
+        authorization = request.headers.get("authorization", "")
+        scheme, _, supplied = authorization.partition(" ")
+        return scheme.lower() == "bearer" and token_matches(
+            supplied.strip(), DIAGNOSTICS_TOKEN
+        )
+    return request.client is not None and request.client.host in LOCAL_HOSTS
+
+
+async def require_diagnostics_access(request: Request):
+    """Dependency that guards the diagnostics endpoints."""
+    if not has_diagnostics_access(request):
+        raise HTTPException(status_code=403, detail="Diagnostics access denied")
+
+
+class LoopLagMonitor:
+    """
+    Detects callbacks that block the event loop. A task on the loop records
+    a heartbeat every interval, and a watchdog thread captures the loop
+    thread's stack when the heartbeat is late by more than the threshold.
+    The stall is logged with that stack once the loop runs again.
+    """
+
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD):
+        self.threshold = threshold
+        self.interval = threshold / 2
+        self.heartbeat = 0.0
+        self.pending_stack = None
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.stalls = deque(maxlen=MAX_RECORDED_STALLS)
+        self.stall_count = 0
+        self.max_lag = 0.0
+
+    def start(self):
+        if self.threshold <= 0 or self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self.beat())
+        self.thread = threading.Thread(
+            target=self.watch, name="loop-lag-monitor", daemon=True
+        )
+        self.thread.start()
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.heartbeat - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                stack, self.pending_stack = self.pending_stack, None
+                self.record(lag, stack)
+
+    def watch(self):
+        captured = None
+        while not self.stopped.wait(self.interval / 2):
+            heartbeat = self.heartbeat
+            if heartbeat == captured:
+                continue
+            if time.monotonic() - heartbeat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.pending_stack = "".join(traceback.format_stack(frame))
+            captured = heartbeat
+
+    def record(self, lag: float, stack: str | None):
+        self.stall_count += 1
+        self.stalls.append(
+            {"at": time.time(), "lag": round(lag, 3), "stack": stack or ""}
+        )
+        logging.warning(
+            "Event loop was blocked for %.3f seconds at:\n%s",
+            lag,
+            stack or "(stack not captured)",
+        )
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopped.set()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await asyncio.to_thread(self.thread.join)
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "stalls": self.stall_count,
+            "max_lag": round(self.max_lag, 3),
+            "recent": list(self.stalls),
+        }
+
+
+class RequestProfile:
+    """cProfile capture of one request, from its start until it is finished."""
+
+    def __init__(self, path: str, trigger: str):
+        self.profile_id = str(uuid.uuid4())
+        self.path = path
+        self.trigger = trigger
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.profiler = cProfile.Profile()
+        self.handed_off = False
+        self.saved_stats = {}
+        self.stats = {}
+
+    def stop(self):
+        self.profiler.disable()
+        self.profiler.create_stats()
+        self.saved_stats = self.profiler.stats
+        self.profiler = None
+        self.duration = time.time() - self.started_at
+
+    def create_stats(self):
+        """Let pstats.Stats load a copy of the stats, as it empties its source."""
+        self.stats = dict(self.saved_stats)
+
+    def summary(self) -> dict:
+        return {
+            "id": self.profile_id,
+            "path": self.path,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "duration": round(self.duration, 3),
+        }
+
+
+class RequestProfiler:
+    """
+    Profiles requests that carry the profiling header set to the diagnostics
+    token, or are picked by the sample rate. cProfile sees every callback on
+    the event loop thread, so a profile also includes whatever else ran at
+    the same time; only one request is profiled at a time to bound that
+    noise and the overhead.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        header: str = PROFILE_HEADER,
+        history: int = PROFILE_HISTORY,
+    ):
+        self.sample_rate = sample_rate
+        self.header = header
+        self.history = history
+        self.active = None
+        self.profiles: OrderedDict[str, RequestProfile] = OrderedDict()
+
+    def trigger(self, headers) -> str | None:
+        if self.header and token_matches(headers.get(self.header), DIAGNOSTICS_TOKEN):
+            return "header"
+        if self.sample_rate > 0 and random.random() * 100 < self.sample_rate:
+            return "sample"
+        return None
+
+    def start(self, path: str, headers) -> RequestProfile | None:
+        if self.active is not None:
+            return None
+        trigger = self.trigger(headers)
+        if trigger is None:
+            return None
+        profile = RequestProfile(path, trigger)
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            logging.warning("Not profiling %s, another profiler is active", path)
+            return None
+        self.active = profile
+        return profile
+
+    def attach(self, profile: RequestProfile | None, task: asyncio.Task):
+        """Keep profiling until a task, such as a response stream, finishes."""
+        if profile is None:
+            return
+        profile.handed_off = True
+        task.add_done_callback(lambda _: self.finish(profile))
+
+    def finish(self, profile: RequestProfile | None):
+        if profile is None or profile is not self.active:
+            return
+        profile.stop()
+        self.active = None
+        self.profiles[profile.profile_id] = profile
+        while len(self.profiles) > self.history:
+            self.profiles.popitem(last=False)
+        logging.info(
+            "Profiled %s in %.3f seconds as %s",
+            profile.path,
+            profile.duration,
+            profile.profile_id,
+        )
+
+    def get(self, profile_id: str) -> RequestProfile:
+        profile = self.profiles.get(profile_id)
+        if profile is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return profile
+
+    def report(self, profile_id: str, sort: str = "cumulative", limit: int = 50):
+        """Render a stored profile as pstats text."""
+        profile = self.get(profile_id)
+        buffer = io.StringIO()
+        try:
+            stats = pstats.Stats(profile, stream=buffer).sort_stats(sort)
+        except KeyError as e:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid sort key: {sort}"
+            ) from e
+        stats.print_stats(limit)
+        return buffer.getvalue()
+
+    def dump(self, profile_id: str) -> bytes:
+        """Return a stored profile in the pstats format that dump_stats writes."""
+        return marshal.dumps(self.get(profile_id).saved_stats)
+
+    def summaries(self) -> list[dict]:
+        return [profile.summary() for profile in reversed(self.profiles.values())]
+
+
+loop_lag_monitor = LoopLagMonitor()
+request_profiler = RequestProfiler()
+
+
+async def profile_request(request: Request):
+    """
+    Dependency that profiles the request if it is selected. Profiles not
+    attached to a task by the endpoint end with the request.
+    """
+    profile = request_profiler.start(request.url.path, request.headers)
+    try:
+        yield profile
+    finally:
+        if profile is not None and not profile.handed_off:
+            request_profiler.finish(profile)
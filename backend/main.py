@@ -3,27 +3,65 @@ This module implements a FastAPI-based server for handling chat interactions,
 managing chat history, and generating audio responses using AI models.
 """
 
+import asyncio
 import logging
+import multiprocessing
 import os
 import sys
 import time
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
 
 import uvicorn
-from fastapi import Cookie, FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import (
+    Cookie,
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Query,
+    Request,
+    UploadFile,
+)
+from fastapi.responses import (
+    HTMLResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 
 from ai import (
     extract_user_input_async,
+    load_language_model,
     process_audio_file_with_language,
     response_stream_generator,
 )
+from archive import export_ndjson, import_ndjson
+from assets import CachedStaticFiles, asset_cache, serve_file
 from chat import chat_storage_manager
-from config import SYSTEM_MESSAGE
-from ollama import does_model_exist, ollama_models
+from config import SYSTEM_MESSAGE, WORKERS
+from diagnostics import (
+    RequestProfile,
+    loop_lag_monitor,
+    profile_request,
+    request_profiler,
+    require_diagnostics_access,
+)
+from memory import inject_memories, retrieval_memory
+from messages import Message, encode
+from ollama import does_model_exist, ollama_models, ollama_router
+from persistence import chat_write_queue
+from streams import stream_registry
+from stt import stt_service
+from summary import (
+    conversation_summarizer,
+    inject_summary,
+    unsummarized_messages,
+)
+from tts import tts_service
 
 logging.basicConfig(
     level=logging.INFO,
@@ -41,6 +79,7 @@ BACKEND_STATIC_DIR = BASE_DIR / "backend" / "static"
 FRONTEND_STATIC_DIR = BASE_DIR / "frontend" / "static"
 DIST_DIR = BASE_DIR / "frontend" / "dist"
 ASSETS_DIR = BASE_DIR / "frontend" / "assets"
+INDEX_FILE = (FRONTEND_DIR / "index.html").resolve()
 
 
 os.makedirs(BACKEND_STATIC_DIR, exist_ok=True)
@@ -49,31 +88,40 @@ os.makedirs(DIST_DIR, exist_ok=True)
 os.makedirs(ASSETS_DIR, exist_ok=True)
 
 
-class FallbackStaticFiles(StaticFiles):
-    def __init__(self, primary_dir, fallback_dir, **kwargs):
-        super().__init__(directory=primary_dir, **kwargs)
-        self.fallback_dir = fallback_dir
-
-    async def get_response(self, path, scope):
-        response = await super().get_response(path, scope)
-        if response.status_code == 404:
-            fallback_file = self.fallback_dir / path
-            if fallback_file.exists() and fallback_file.is_file():
-                from fastapi.responses import FileResponse
-
-                return FileResponse(fallback_file)
-        return response
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up long-lived resources before serving and release them on exit."""
+    stt_service.start()
+    loop_lag_monitor.start()
+    tts_service.load()
+    load_language_model()
+    ollama_router.start_health_checks()
+    backfill_task = asyncio.create_task(
+        asyncio.to_thread(chat_storage_manager.backfill_search_index)
+    )
+    chat_write_queue.start()
+    await asyncio.to_thread(asset_cache.preload, DIST_DIR)
+    yield
+    await stream_registry.shutdown()
+    await chat_write_queue.stop()
+    await backfill_task
+    await conversation_summarizer.shutdown()
+    await retrieval_memory.shutdown()
+    await ollama_router.stop_health_checks()
+    stt_service.shutdown()
+    await loop_lag_monitor.stop()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.mount(
     "/static",
-    FallbackStaticFiles(BACKEND_STATIC_DIR, FRONTEND_STATIC_DIR),
+    CachedStaticFiles(BACKEND_STATIC_DIR, FRONTEND_STATIC_DIR),
     name="static",
 )
-app.mount("/dist", StaticFiles(directory=DIST_DIR), name="dist")
-app.mount("/assets", StaticFiles(directory=ASSETS_DIR), name="assets")
+app.mount("/dist", CachedStaticFiles(DIST_DIR), name="dist")
+app.mount("/assets", CachedStaticFiles(ASSETS_DIR), name="assets")
+favicon_files = CachedStaticFiles(BASE_DIR / "backend", BACKEND_STATIC_DIR, ASSETS_DIR)
 
 
 @app.post("/api/chat/")
@@ -85,10 +133,11 @@ async def chat_llm_api(
     model: Optional[str] = Form(None),
     language: Optional[str] = Form(None),
     system_message: Optional[str] = Form(None),
+    profile: Optional[RequestProfile] = Depends(profile_request),
 ):
     """Handles chat requests and manages chat history."""
-    if channel_id and not chat_storage_manager.does_channel_exist(
-        session_id, channel_id
+    if channel_id and not await asyncio.to_thread(
+        chat_storage_manager.does_channel_exist, session_id, channel_id
     ):
         logging.error(
             "Channel %s does not exist for session %s.", channel_id, session_id
@@ -99,7 +148,6 @@ async def chat_llm_api(
     if not does_model_exist(model):
         raise HTTPException(status_code=404, detail="Model does not exist")
 
-    is_channel_created = False
     step_start_time = time.time()
     is_file_uploaded = file is not None and not text
 
@@ -119,11 +167,16 @@ async def chat_llm_api(
 
     if not channel_id:
         channel_id = str(uuid.uuid4())
-        is_channel_created = True
-        channel = chat_storage_manager.create_channel(session_id, channel_id, text)
+        channel = await asyncio.to_thread(
+            chat_storage_manager.create_channel, session_id, channel_id, text
+        )
 
     step_start_time = time.time()
-    chat_history = chat_storage_manager.load_chat_history(session_id, channel_id, True)
+    await chat_write_queue.sync(channel_id)
+    history = await asyncio.to_thread(
+        chat_storage_manager.load_chat_history, session_id, channel_id
+    )
+    chat_history = chat_storage_manager.truncate_context(history)
 
     logging.info(
         "Loaded chat history for channel %s. Time taken: %.2f seconds",
@@ -131,13 +184,29 @@ async def chat_llm_api(
         time.time() - step_start_time,
     )
 
-    if not chat_history or chat_history[0].get("role") != "system":
-        chat_history.insert(0, {"role": "system", "content": SYSTEM_MESSAGE})
+    channel_summary = await asyncio.to_thread(
+        chat_storage_manager.get_channel_summary, channel_id
+    )
+    unsummarized = unsummarized_messages(history, chat_history, channel_summary)
 
-    chat_history.append({"role": "user", "content": user_input})
+    if not chat_history or chat_history[0].role != "system":
+        chat_history.insert(0, Message("system", SYSTEM_MESSAGE))
 
-    chat_history = chat_history[::-1] if not is_channel_created else chat_history
-    return StreamingResponse(
+    chat_history = inject_summary(
+        chat_history,
+        channel_summary.summary if channel_summary else None,
+        unsummarized,
+    )
+
+    memories = await retrieval_memory.recall(channel_id, user_input, chat_history)
+    chat_history = inject_memories(chat_history, memories)
+
+    chat_history.append(Message("user", user_input))
+
+    stream_id = str(uuid.uuid4())
+    stream = stream_registry.start(
+        stream_id,
+        session_id,
         response_stream_generator(
             channel,
             channel_id,
@@ -147,8 +216,38 @@ async def chat_llm_api(
             chat_history,
             model,
             language,
+            stream_id if stream_registry.resumable else None,
         ),
+    )
+    headers = {"X-Stream-Id": stream_id} if stream_registry.resumable else {}
+    if profile is not None:
+        request_profiler.attach(profile, stream.task)
+        headers["X-Profile-Id"] = profile.profile_id
+    return StreamingResponse(
+        stream_registry.read(stream),
+        media_type="text/plain",
+        headers=headers,
+    )
+
+
+@app.get("/api/chat/stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    offset: int = Query(0, ge=0),
+    session_id: Optional[str] = Cookie(default=None),
+):
+    """Resume a chat response stream from a byte offset after a disconnect."""
+    stream = stream_registry.get(stream_id, session_id)
+    if offset < stream.base_offset:
+        raise HTTPException(
+            status_code=410, detail="Offset is no longer buffered for this stream"
+        )
+    if offset > stream.end_offset:
+        raise HTTPException(status_code=416, detail="Offset is beyond the stream")
+    return StreamingResponse(
+        stream_registry.read(stream, offset),
         media_type="text/plain",
+        headers={"X-Stream-Id": stream_id},
     )
 
 
@@ -163,9 +262,12 @@ async def get_history(
     if not channel_id:
         logging.error("Channel ID is missing in request to get history.")
         raise HTTPException(status_code=400, detail="Channel id missing")
-    chat_history = chat_storage_manager.load_chat_history(session_id, channel_id)
+    await chat_write_queue.sync(channel_id)
+    chat_history = await asyncio.to_thread(
+        chat_storage_manager.load_chat_history, session_id, channel_id
+    )
     logging.info("Retrieved history for channel %s.", channel_id)
-    return {"history": chat_history}
+    return Response(encode({"history": chat_history}), media_type="application/json")
 
 
 @app.delete("/api/history/{channel_id}/")
@@ -177,7 +279,8 @@ async def delete_history(
     if not session_id:
         logging.error("Session ID is missing in request to delete history.")
         raise HTTPException(status_code=400, detail="Session id missing")
-    chat_storage_manager.delete_channel(session_id, channel_id)
+    await asyncio.to_thread(chat_storage_manager.delete_channel, session_id, channel_id)
+    retrieval_memory.forget(channel_id)
     logging.info("Deleted history for channel %s.", channel_id)
     return {"success": "true", "message": "History deleted successfully."}
 
@@ -188,19 +291,114 @@ async def delete_all_history(session_id: Optional[str] = Cookie(default=None)):
     if not session_id:
         logging.error("Session ID is missing in request to delete all history.")
         raise HTTPException(status_code=400, detail="Session id missing")
-    chat_storage_manager.delete_all_channels(session_id)
+    channels = await asyncio.to_thread(chat_storage_manager.get_channels, session_id)
+    await asyncio.to_thread(chat_storage_manager.delete_all_channels, session_id)
+    channel_ids = [channel["id"] for channel in channels]
+    for channel_id in channel_ids:
+        retrieval_memory.forget(channel_id)
     logging.info("Deleted all history for session %s.", session_id)
     return {"success": "true", "message": "History deleted successfully."}
 
 
+@app.get("/api/search")
+async def search_history(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    session_id: Optional[str] = Cookie(default=None),
+):
+    """Search the messages of all channels of the session."""
+    if not session_id:
+        logging.error("Session ID is missing in request to search history.")
+        raise HTTPException(status_code=400, detail="Session id missing")
+    results = await asyncio.to_thread(chat_storage_manager.search, session_id, q, limit)
+    return {"results": results}
+
+
+@app.get("/api/export")
+async def export_history(session_id: Optional[str] = Cookie(default=None)):
+    """Stream all channels and messages of the session as NDJSON."""
+    if not session_id:
+        logging.error("Session ID is missing in request to export history.")
+        raise HTTPException(status_code=400, detail="Session id missing")
+    for channel in await asyncio.to_thread(
+        chat_storage_manager.get_channels, session_id
+    ):
+        await chat_write_queue.sync(channel["id"])
+    return StreamingResponse(
+        export_ndjson(session_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="yukiai-export.ndjson"'},
+    )
+
+
+@app.post("/api/import")
+async def import_history(
+    file: UploadFile = File(...),
+    session_id: Optional[str] = Cookie(default=None),
+):
+    """Import channels from an NDJSON export into the session."""
+    if not session_id:
+        logging.error("Session ID is missing in request to import history.")
+        raise HTTPException(status_code=400, detail="Session id missing")
+    return await import_ndjson(session_id, file)
+
+
 @app.get("/api/data")
 async def get_init_data(session_id: Optional[str] = Cookie(default=None)):
     user_id = session_id
-    channels = chat_storage_manager.get_channels(user_id)
+    channels = await asyncio.to_thread(chat_storage_manager.get_channels, user_id)
     models = ollama_models if ollama_models is not None else []
     return {"channels": channels, "models": models}
 
 
+@app.get("/api/ollama/hosts")
+async def get_ollama_hosts():
+    """Health, routing and latency stats for each Ollama host."""
+    return {"hosts": ollama_router.stats()}
+
+
+@app.get("/api/persistence/stats")
+async def get_persistence_stats():
+    """Queue depth and write lag of the chat history write-behind queue."""
+    return chat_write_queue.stats()
+
+
+@app.get("/api/diagnostics/loop", dependencies=[Depends(require_diagnostics_access)])
+async def get_loop_diagnostics():
+    """Event loop stalls with the stack that blocked the loop."""
+    return loop_lag_monitor.stats()
+
+
+@app.get(
+    "/api/diagnostics/profiles", dependencies=[Depends(require_diagnostics_access)]
+)
+async def get_profiles():
+    """Recent request profiles, newest first."""
+    return {"profiles": request_profiler.summaries()}
+
+
+@app.get(
+    "/api/diagnostics/profiles/{profile_id}",
+    dependencies=[Depends(require_diagnostics_access)],
+)
+async def get_profile(
+    profile_id: str,
+    sort: str = Query("cumulative"),
+    limit: int = Query(50, ge=1),
+    format: str = Query("text"),
+):
+    """A request profile as pstats text, or as a .prof file with format=pstats."""
+    if format == "pstats":
+        return Response(
+            request_profiler.dump(profile_id),
+            media_type="application/octet-stream",
+            headers={
+                "Content-Disposition": f'attachment; filename="{profile_id}.prof"'
+            },
+        )
+    return PlainTextResponse(request_profiler.report(profile_id, sort, limit))
+
+
 @app.middleware("http")
 async def add_session_id(request, call_next):
     """Middleware to add a session ID to the request if it doesn't exist."""
@@ -214,26 +412,37 @@ async def add_session_id(request, call_next):
 
 
 @app.get("/", response_class=HTMLResponse)
-async def get_index():
-    return FileResponse(FRONTEND_DIR / "index.html")
+async def get_index(request: Request):
+    return await serve_file(INDEX_FILE, request.headers)
 
 
 @app.get("/c/{id}", response_class=HTMLResponse)
-async def get_index_chat(id: str):
-    return FileResponse(FRONTEND_DIR / "index.html")
+async def get_index_chat(id: str, request: Request):
+    return await serve_file(INDEX_FILE, request.headers)
 
 
 @app.get("/favicon.ico", include_in_schema=False)
-async def get_favicon():
+async def get_favicon(request: Request):
     """Serve the favicon."""
-    from io import BytesIO
+    return await favicon_files.get_response("favicon.ico", request.scope)
 
-    with open(os.path.join("favicon.ico"), "rb") as f:
-        favicon_content = f.read()
-    return StreamingResponse(BytesIO(favicon_content), media_type="image/x-icon")
 
+def prepare_workers():
+    """
+    Do the one-time startup work in the parent process before the workers
+    are spawned. Importing this module has already created the database
+    schema and shared the Ollama host state, and backfilling the search index
+    here leaves the workers nothing to catch up on.
+    """
+    chat_storage_manager.backfill_search_index()
 
-if __name__ == "__main__":
-    logging.info("Starting FastAPI server...")
 
-    uvicorn.run(app, host="0.0.0.0", port=8010)
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if WORKERS > 1:
+        prepare_workers()
+        logging.info("Starting FastAPI server with %d workers...", WORKERS)
+        uvicorn.run("main:app", host="0.0.0.0", port=8010, workers=WORKERS)
+    else:
+        logging.info("Starting FastAPI server...")
+        uvicorn.run(app, host="0.0.0.0", port=8010)
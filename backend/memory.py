@@ -0,0 +1,193 @@
+"""
+This module implements retrieval memory: stored messages are embedded with
+Ollama, and the earlier messages most similar to the user's input are added
+to the prompt.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from chat import chat_storage_manager
+from config import EMBEDDING_MODEL, MEMORY_MIN_SCORE, MEMORY_TOP_K
+from messages import Message
+from ollama import embed_ollama
+
+MAX_CACHED_INDEXES = 256
+
+
+def normalize(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ChannelIndex:
+    """Normalized embedding matrix of one channel for cosine top-k search."""
+
+    def __init__(self):
+        self.roles: list[str] = []
+        self.contents: list[str] = []
+        self.matrix: np.ndarray | None = None
+        self.next_position = 0
+
+    def add(self, positions, roles, contents, matrix: np.ndarray):
+        self.next_position = positions[-1] + 1
+        self.roles.extend(roles)
+        self.contents.extend(contents)
+        if self.matrix is None:
+            self.matrix = matrix
+        else:
+            self.matrix = np.vstack([self.matrix, matrix])
+
+    def search(self, query: np.ndarray, k: int, exclude: set[str]):
+        if self.matrix is None or k <= 0:
+            return []
+        scores = self.matrix @ query.reshape(-1)
+        count = min(len(scores), k + len(exclude))
+        top = np.argpartition(-scores, count - 1)[:count]
+        results = []
+        for i in top[np.argsort(-scores[top])]:
+            if scores[i] < MEMORY_MIN_SCORE or self.contents[i] in exclude:
+                continue
+            results.append((self.roles[i], self.contents[i], float(scores[i])))
+            if len(results) == k:
+                break
+        return results
+
+
+def inject_memories(chat_history, memories):
+    """Insert recalled messages after the leading system messages."""
+    if not memories:
+        return chat_history
+    index = 0
+    while index < len(chat_history) and chat_history[index].role == "system":
+        index += 1
+    recalled = "\n".join(f"{role}: {content}" for role, content, _ in memories)
+    memory_message = Message(
+        "system", f"Relevant messages from earlier in the conversation:\n{recalled}"
+    )
+    return chat_history[:index] + [memory_message] + chat_history[index:]
+
+
+class RetrievalMemory:
+    """
+    Embeds new messages in background tasks after each turn and answers
+    top-k similarity queries from per-channel in-memory indexes, kept in
+    step with the embeddings stored in the database.
+    """
+
+    def __init__(self, model: str = EMBEDDING_MODEL, top_k: int = MEMORY_TOP_K):
+        self.model = model
+        self.top_k = top_k
+        self.indexes: OrderedDict[str, ChannelIndex] = OrderedDict()
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.model) and self.top_k > 0
+
+    async def get_index(self, channel_id: str) -> ChannelIndex:
+        """
+        Return the cached index of a channel, first adding any embeddings
+        stored since it was loaded, including those stored by other workers.
+        """
+        index = self.indexes.get(channel_id)
+        if index is None:
+            index = ChannelIndex()
+            self.indexes[channel_id] = index
+            if len(self.indexes) > MAX_CACHED_INDEXES:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(channel_id)
+
+        rows = await asyncio.to_thread(
+            chat_storage_manager.load_message_embeddings,
+            channel_id,
+            index.next_position,
+        )
+        # Another recall may have added the same rows while these were loading.
+        rows = [row for row in rows if row.position >= index.next_position]
+        if rows:
+            index.add(
+                [row.position for row in rows],
+                [row.role for row in rows],
+                [row.content for row in rows],
+                np.stack(
+                    [np.frombuffer(row.embedding, dtype=np.float32) for row in rows]
+                ),
+            )
+        return index
+
+    def forget(self, channel_id: str):
+        self.indexes.pop(channel_id, None)
+
+    def schedule(self, user_id: str, channel_id: str):
+        if not self.enabled or channel_id in self.tasks:
+            return
+        task = asyncio.create_task(self.index_new_messages(user_id, channel_id))
+        self.tasks[channel_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(channel_id, None))
+
+    async def index_new_messages(self, user_id: str, channel_id: str):
+        try:
+            history, offset = await asyncio.to_thread(
+                chat_storage_manager.load_chat_history_window, user_id, channel_id
+            )
+            start = await asyncio.to_thread(
+                chat_storage_manager.count_embedded_messages, channel_id
+            )
+            # Positions count from the first message ever stored, so they
+            # keep growing after the oldest messages are trimmed.
+            pending = [
+                (position, message.role, message.content)
+                for position, message in enumerate(history, offset)
+                if position >= start and message.role != "system" and message.content
+            ]
+            if not pending:
+                return
+
+            vectors = await embed_ollama(
+                self.model, [content for _, _, content in pending]
+            )
+            matrix = normalize(vectors)
+            await asyncio.to_thread(
+                chat_storage_manager.save_message_embeddings,
+                channel_id,
+                [
+                    (position, role, content, vector.tobytes())
+                    for (position, role, content), vector in zip(pending, matrix)
+                ],
+            )
+        except Exception:
+            logging.exception("Failed to embed messages of channel %s", channel_id)
+
+    async def recall(self, channel_id: str, query: str, chat_history):
+        """
+        Return up to top_k (role, content, score) tuples of earlier messages
+        similar to the query, skipping those already in the prompt.
+        """
+        if not self.enabled or not query:
+            return []
+        try:
+            index = await self.get_index(channel_id)
+            if index.matrix is None:
+                return []
+            vectors = await embed_ollama(self.model, [query])
+            exclude = {message.content for message in chat_history}
+            return index.search(normalize(vectors)[0], self.top_k, exclude)
+        except Exception:
+            logging.exception("Failed to recall messages of channel %s", channel_id)
+            return []
+
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+retrieval_memory = RetrievalMemory()
@@ -0,0 +1,103 @@
+"""
+This module defines the chat message type used throughout the server and
+the msgspec JSON codec used to store messages and build Ollama requests.
+"""
+
+import time
+
+import msgspec
+
+
+class Message(msgspec.Struct, omit_defaults=True, gc=False):
+    """A single chat message. Empty optional fields are left out of JSON."""
+
+    role: str
+    content: str = ""
+    audio_url: str = ""
+    created_at: float = 0.0
+
+
+def new_message(role: str, content: str, audio_url: str = "") -> Message:
+    return Message(role, content, audio_url, time.time())
+
+
+class ChannelRecord(msgspec.Struct, tag="channel", omit_defaults=True):
+    """Channel line of an NDJSON export."""
+
+    channel_id: str
+    channel_name: str = ""
+    created_at: str = ""
+
+
+class MessageRecord(msgspec.Struct, tag="message", omit_defaults=True, gc=False):
+    """Message line of an NDJSON export, following its channel line."""
+
+    channel_id: str
+    role: str
+    content: str = ""
+    audio_url: str = ""
+    created_at: float = 0.0
+
+
+class StatsRecord(msgspec.Struct, tag="stats"):
+    """Trailing line of an NDJSON export with its size and throughput."""
+
+    channels: int
+    messages: int
+    seconds: float
+    messages_per_second: float
+
+
+encoder = msgspec.json.Encoder()
+history_decoder = msgspec.json.Decoder(list[Message])
+record_decoder = msgspec.json.Decoder(ChannelRecord | MessageRecord | StatsRecord)
+
+
+def encode(obj) -> bytes:
+    return encoder.encode(obj)
+
+
+def decode(data: bytes | str):
+    return msgspec.json.decode(data)
+
+
+def encode_history(history: list[Message]) -> str:
+    return encoder.encode(history).decode("utf-8")
+
+
+def decode_history(data: bytes | str | None) -> list[Message]:
+    if not data:
+        return []
+    return history_decoder.decode(data)
+
+
+def encode_llm_messages(messages: list[Message]) -> bytes:
+    """
+    Encode only the role and content of each message, writing the JSON
+    directly instead of building a projected copy of every message.
+    """
+    buffer = bytearray(b"[")
+    for index, message in enumerate(messages):
+        if index:
+            buffer += b","
+        buffer += b'{"role":'
+        buffer += encoder.encode(message.role)
+        buffer += b',"content":'
+        buffer += encoder.encode(message.content)
+        buffer += b"}"
+    buffer += b"]"
+    return bytes(buffer)
+
+
+def encode_chat_request(model: str, messages: list[Message], stream: bool) -> bytes:
+    return b"".join(
+        [
+            b'{"model":',
+            encoder.encode(model),
+            b',"stream":',
+            b"true" if stream else b"false",
+            b',"messages":',
+            encode_llm_messages(messages),
+            b"}",
+        ]
+    )
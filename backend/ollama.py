@@ -1,34 +1,273 @@
-import json
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 
 import aiohttp
+import msgspec
 import requests
 from fastapi import HTTPException
 
-from config import ollama_tags_url, ollama_url
+from chat import chat_storage_manager
+from config import (
+    OLLAMA_CONNECT_TIMEOUT,
+    OLLAMA_HEALTH_INTERVAL,
+    OLLAMA_READ_TIMEOUT,
+    ollama_hosts,
+    ollama_tags_url,
+    ollama_url,
+)
+from messages import Message, decode, encode_chat_request
 
 ollama_models = []
 
+LATENCY_SMOOTHING = 0.2
+JSON_HEADERS = {"Content-Type": "application/json"}
+MAX_CHANNEL_AFFINITIES = 10000
+SHARED_STATE_KEY = "ollama_hosts"
 
-def list_ollama_models():
-    """List available models from the Ollama server."""
-    global ollama_models
 
-    try:
-        response = requests.get(ollama_tags_url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            models = data.get("models", [])
-            ollama_models = models
-            logging.info("Fetched models: %s", ollama_models)
-        return []
-    except Exception as e:
-        logging.error(e)
-        pass
+def request_timeout() -> aiohttp.ClientTimeout:
+    """
+    Timeouts of Ollama requests. A host must accept the connection within
+    the connect timeout and send each part of the response, including the
+    first token, within the read timeout. There is no limit on the total
+    time, so long generations that keep streaming are not cut off.
+    """
+    return aiohttp.ClientTimeout(
+        total=None, sock_connect=OLLAMA_CONNECT_TIMEOUT, sock_read=OLLAMA_READ_TIMEOUT
+    )
+
+
+class OllamaHost:
+    """An Ollama server in the pool, with its health and latency stats."""
+
+    def __init__(self, url: str, chat_url: str, tags_url: str):
+        self.url = url
+        self.chat_url = chat_url
+        self.tags_url = tags_url
+        self.ps_url = f"{url}/api/ps"
+        self.embed_url = f"{url}/api/embed"
+        self.healthy = True
+        self.models = []
+        self.loaded_models = set()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.first_token_latency = 0.0
+        self.total_latency = 0.0
+
+    def has_model(self, model: str) -> bool:
+        return any(m["name"] == model for m in self.models)
+
+    def record_latency(self, attr: str, elapsed: float):
+        previous = getattr(self, attr)
+        if previous == 0.0:
+            setattr(self, attr, elapsed)
+        else:
+            setattr(
+                self,
+                attr,
+                LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * previous,
+            )
+
+    def update_tags(self, data: dict):
+        self.models = data.get("models", [])
+        self.healthy = True
+
+    def shared_state(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "models": self.models,
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+    def apply_shared_state(self, state: dict):
+        self.healthy = state["healthy"]
+        self.models = state["models"]
+        self.loaded_models = set(state["loaded_models"])
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "models": [m["name"] for m in self.models],
+            "loaded_models": sorted(self.loaded_models),
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "first_token_latency": round(self.first_token_latency, 3),
+            "total_latency": round(self.total_latency, 3),
+        }
+
+
+class OllamaRouter:
+    """
+    Routes chat requests across a pool of Ollama hosts. Requests prefer the
+    host a channel last used, then hosts with the model already loaded, then
+    the host with the fewest outstanding requests.
+    """
+
+    def __init__(self, hosts: list[OllamaHost]):
+        self.hosts = hosts
+        self.affinity: OrderedDict[str, OllamaHost] = OrderedDict()
+        self.health_task = None
+
+    def update_models(self):
+        merged = {}
+        for host in self.hosts:
+            if host.healthy:
+                for model in host.models:
+                    merged.setdefault(model["name"], model)
+        ollama_models[:] = list(merged.values())
+
+    def refresh(self):
+        """Probe every host synchronously. Used once at import time."""
+        for host in self.hosts:
+            try:
+                response = requests.get(host.tags_url, timeout=10)
+                if response.status_code == 200:
+                    host.update_tags(response.json())
+                else:
+                    host.healthy = False
+            except Exception as e:
+                host.healthy = False
+                logging.error(e)
+        self.update_models()
+        self.publish(self.shared_state())
+        logging.info("Fetched models: %s", ollama_models)
+
+    def shared_state(self) -> dict:
+        return {host.url: host.shared_state() for host in self.hosts}
+
+    def publish(self, state: dict):
+        """
+        Share the probed host state with the other worker processes. Writes
+        to the database, so the event loop runs it in a worker thread.
+        """
+        try:
+            chat_storage_manager.set_shared_state(SHARED_STATE_KEY, state)
+        except Exception:
+            logging.exception("Failed to share Ollama host state")
+
+    def load_shared(self, max_age: float = OLLAMA_HEALTH_INTERVAL) -> bool:
+        """
+        Adopt the host state another worker probed within max_age seconds.
+        Returns False if there is none and the hosts should be probed.
+        """
+        return self.apply_shared(
+            chat_storage_manager.get_shared_state(SHARED_STATE_KEY, max_age)
+        )
+
+    def apply_shared(self, state: dict | None) -> bool:
+        if state is None:
+            return False
+        for host in self.hosts:
+            if host.url in state:
+                host.apply_shared_state(state[host.url])
+        self.update_models()
+        return True
+
+    async def probe(self, session: aiohttp.ClientSession, host: OllamaHost):
+        try:
+            async with session.get(host.tags_url) as response:
+                if response.status != 200:
+                    host.healthy = False
+                    return
+                host.update_tags(await response.json())
+            async with session.get(host.ps_url) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    host.loaded_models = {m["name"] for m in data.get("models", [])}
+        except Exception as e:
+            if host.healthy:
+                logging.warning("Ollama host %s is unhealthy: %s", host.url, e)
+            host.healthy = False
+
+    async def refresh_async(self):
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*(self.probe(session, host) for host in self.hosts))
+        self.update_models()
+        await asyncio.to_thread(self.publish, self.shared_state())
+
+    async def health_check_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                state = await asyncio.to_thread(
+                    chat_storage_manager.get_shared_state, SHARED_STATE_KEY, interval
+                )
+                if not self.apply_shared(state):
+                    await self.refresh_async()
+            except Exception:
+                logging.exception("Ollama health check failed")
+
+    def start_health_checks(self, interval: float = OLLAMA_HEALTH_INTERVAL):
+        if self.health_task is None and interval > 0:
+            self.health_task = asyncio.create_task(self.health_check_loop(interval))
 
+    async def stop_health_checks(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            try:
+                await self.health_task
+            except asyncio.CancelledError:
+                pass
+            self.health_task = None
 
-async def ask_ollama_stream(model: str, chat_history):
-    """Send a request to the Ollama server and stream the response."""
+    def candidates(self, model: str, channel_id: str | None = None):
+        hosts = [h for h in self.hosts if h.healthy and h.has_model(model)]
+        if not hosts:
+            hosts = [h for h in self.hosts if h.healthy] or list(self.hosts)
+
+        sticky = self.affinity.get(channel_id) if channel_id else None
+        hosts.sort(
+            key=lambda h: (
+                h is not sticky,
+                model not in h.loaded_models,
+                h.outstanding,
+                h.first_token_latency,
+            )
+        )
+        return hosts
+
+    def pin(self, channel_id: str | None, host: OllamaHost):
+        if not channel_id:
+            return
+        self.affinity[channel_id] = host
+        self.affinity.move_to_end(channel_id)
+        if len(self.affinity) > MAX_CHANNEL_AFFINITIES:
+            self.affinity.popitem(last=False)
+
+    def stats(self) -> list[dict]:
+        return [host.stats() for host in self.hosts]
+
+
+def build_router() -> OllamaRouter:
+    if len(ollama_hosts) == 1:
+        return OllamaRouter([OllamaHost(ollama_hosts[0], ollama_url, ollama_tags_url)])
+    return OllamaRouter(
+        [OllamaHost(url, f"{url}/api/chat", f"{url}/api/tags") for url in ollama_hosts]
+    )
+
+
+ollama_router = build_router()
+
+
+def list_ollama_models():
+    """List available models from the Ollama servers."""
+    ollama_router.refresh()
+    return ollama_models
+
+
+async def ask_ollama_stream(
+    model: str, chat_history: list[Message], channel_id: str = None
+):
+    """
+    Send a request to the Ollama pool and stream the response. Hosts are
+    tried in routing order until one starts responding.
+    """
 
     if not chat_history:
         raise HTTPException(
@@ -38,28 +277,119 @@ async def ask_ollama_stream(model: str, chat_history):
         logging.error("Model is not provided.")
         raise HTTPException(status_code=500)
 
-    payload = {"model": model, "stream": True, "messages": chat_history}
+    payload = encode_chat_request(model, chat_history, stream=True)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ollama_url, json=payload) as response:
-            if response.status == 200:
-                async for line in response.content:
-                    try:
-                        line = line.decode("utf-8").strip()
-                        if not line:
+    async with aiohttp.ClientSession(timeout=request_timeout()) as session:
+        for host in ollama_router.candidates(model, channel_id):
+            start_time = time.time()
+            started = False
+            host.outstanding += 1
+            host.requests += 1
+            try:
+                async with session.post(
+                    host.chat_url, data=payload, headers=JSON_HEADERS
+                ) as response:
+                    if response.status != 200:
+                        host.failures += 1
+                        logging.error(
+                            f"Failed to get response from Ollama host {host.url}. Status code: {response.status}"
+                        )
+                        logging.error(f"Response content: {await response.text()}")
+                        continue
+
+                    async for line in response.content:
+                        try:
+                            line = line.decode("utf-8").strip()
+                            if not line:
+                                continue
+                            chunk = decode(line)
+                        except msgspec.DecodeError as e:
+                            logging.error(f"JSONDecodeError: {e} - Line: {line}")
+                            continue
+                        except Exception as e:
+                            logging.error(f"Unexpected error: {e}")
                             continue
-                        chunk = json.loads(line)
+                        if not started:
+                            started = True
+                            host.record_latency(
+                                "first_token_latency", time.time() - start_time
+                            )
+                            host.loaded_models.add(model)
+                            ollama_router.pin(channel_id, host)
                         yield chunk
-                    except json.JSONDecodeError as e:
-                        logging.error(f"JSONDecodeError: {e} - Line: {line}")
-                    except Exception as e:
-                        logging.error(f"Unexpected error: {e}")
-            else:
-                logging.error(
-                    f"Failed to get response from Ollama. Status code: {response.status}"
-                )
-                logging.error(f"Response content: {await response.text()}")
-                yield "Failed to get response from Ollama"
+                    host.record_latency("total_latency", time.time() - start_time)
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                host.failures += 1
+                if started:
+                    raise
+                host.healthy = False
+                logging.error(f"Ollama host {host.url} failed: {e!r}")
+            finally:
+                host.outstanding -= 1
+
+    yield "Failed to get response from Ollama"
+
+
+async def ask_ollama(
+    model: str, messages: list[Message], channel_id: str = None
+) -> str:
+    """Send a non-streaming request to the Ollama pool and return the reply."""
+    payload = encode_chat_request(model, messages, stream=False)
+
+    async with aiohttp.ClientSession(timeout=request_timeout()) as session:
+        for host in ollama_router.candidates(model, channel_id):
+            start_time = time.time()
+            host.outstanding += 1
+            host.requests += 1
+            try:
+                async with session.post(
+                    host.chat_url, data=payload, headers=JSON_HEADERS
+                ) as response:
+                    if response.status != 200:
+                        host.failures += 1
+                        logging.error(
+                            f"Failed to get response from Ollama host {host.url}. Status code: {response.status}"
+                        )
+                        continue
+                    data = decode(await response.read())
+                    host.record_latency("total_latency", time.time() - start_time)
+                    host.loaded_models.add(model)
+                    return data.get("message", {}).get("content") or ""
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                host.failures += 1
+                host.healthy = False
+                logging.error(f"Ollama host {host.url} failed: {e!r}")
+            finally:
+                host.outstanding -= 1
+
+    raise Exception("Failed to get response from Ollama")
+
+
+async def embed_ollama(model: str, inputs: list[str]) -> list[list[float]]:
+    """Embed a batch of texts with the Ollama embeddings API."""
+    payload = {"model": model, "input": inputs}
+
+    async with aiohttp.ClientSession(timeout=request_timeout()) as session:
+        for host in ollama_router.candidates(model):
+            host.outstanding += 1
+            try:
+                async with session.post(host.embed_url, json=payload) as response:
+                    if response.status != 200:
+                        logging.error(
+                            f"Failed to get embeddings from Ollama host {host.url}. Status code: {response.status}"
+                        )
+                        continue
+                    data = await response.json()
+                    return data.get("embeddings", [])
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                host.failures += 1
+                host.healthy = False
+                logging.error(f"Ollama host {host.url} failed: {e!r}")
+            finally:
+                host.outstanding -= 1
+
+    raise Exception("Failed to get embeddings from Ollama")
 
 
 def does_model_exist(model_name: str) -> bool:
@@ -71,6 +401,7 @@ def does_model_exist(model_name: str) -> bool:
 
 
 try:
-    list_ollama_models()
+    if not ollama_router.load_shared():
+        list_ollama_models()
 except Exception as e:
     logging.error("An error occured while fetching ollama models: %s", e)
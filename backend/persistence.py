@@ -0,0 +1,157 @@
+"""
+This module implements a write-behind queue for chat turns. Turns are
+buffered in memory and written in grouped transactions on a short interval,
+so responses do not wait for database commits.
+"""
+
+import asyncio
+import logging
+import time
+
+from chat import chat_storage_manager
+from config import PERSIST_FLUSH_INTERVAL
+
+MAX_FLUSH_ATTEMPTS = 3
+
+
+class PendingTurn:
+    def __init__(self, user_id: str, channel_id: str, messages, on_commit=None):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.messages = messages
+        self.on_commit = on_commit
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class ChatWriteQueue:
+    """
+    Buffers chat turns and commits everything pending in one transaction per
+    flush. A single flush task writes one batch at a time in a worker thread,
+    so turns of a channel are written in the order they were queued.
+    """
+
+    def __init__(self, interval: float = PERSIST_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending: list[PendingTurn] = []
+        self.writing: list[PendingTurn] = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.flushes = 0
+        self.turns_written = 0
+        self.last_batch_size = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.stopping = False
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Let the flush task write everything still pending, then end it."""
+        if self.task is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        self.task = None
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if not self.stopping:
+                await asyncio.sleep(self.interval)
+            self.wakeup.clear()
+            await self.flush()
+            if self.stopping and not self.pending:
+                return
+
+    def enqueue(self, user_id: str, channel_id: str, messages, on_commit=None):
+        turn = PendingTurn(user_id, channel_id, messages, on_commit)
+        self.pending.append(turn)
+        self.start()
+        self.wakeup.set()
+        return turn.done
+
+    async def sync(self, channel_id: str):
+        """
+        Wait until the queued turns of a channel, including those being
+        written right now, are committed.
+        """
+        waiting = [
+            turn.done
+            for turn in self.writing + self.pending
+            if turn.channel_id == channel_id
+        ]
+        if waiting:
+            await asyncio.gather(*waiting, return_exceptions=True)
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self.writing = batch
+        try:
+            await asyncio.to_thread(
+                chat_storage_manager.append_chat_turns,
+                [(turn.user_id, turn.channel_id, turn.messages) for turn in batch],
+            )
+        except Exception as e:
+            logging.exception("Failed to write %d chat turns", len(batch))
+            retry = []
+            for turn in batch:
+                turn.attempts += 1
+                if turn.attempts < MAX_FLUSH_ATTEMPTS:
+                    retry.append(turn)
+                elif not turn.done.done():
+                    turn.done.set_exception(e)
+            self.pending = retry + self.pending
+            if self.pending:
+                self.wakeup.set()
+            return
+        finally:
+            self.writing = []
+
+        now = time.monotonic()
+        for turn in batch:
+            lag = now - turn.enqueued_at
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+            self.last_lag = lag
+            if not turn.done.done():
+                turn.done.set_result(None)
+            if turn.on_commit:
+                try:
+                    turn.on_commit()
+                except Exception:
+                    logging.exception("Chat turn commit callback failed")
+
+        self.flushes += 1
+        self.turns_written += len(batch)
+        self.last_batch_size = len(batch)
+
+    def stats(self) -> dict:
+        oldest = self.pending[0].enqueued_at if self.pending else None
+        return {
+            "pending": len(self.pending),
+            "writing": len(self.writing),
+            "oldest_pending_age": (
+                round(time.monotonic() - oldest, 3) if oldest is not None else 0.0
+            ),
+            "flushes": self.flushes,
+            "turns_written": self.turns_written,
+            "last_batch_size": self.last_batch_size,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+            "average_lag": round(self.total_lag / self.turns_written, 3)
+            if self.turns_written
+            else 0.0,
+        }
+
+
+chat_write_queue = ChatWriteQueue()
@@ -6,9 +6,12 @@ from tempfile import gettempdir
 
 import edge_tts
 import regex
-import speech_recognition as sr
 from fastapi import HTTPException
 
+from config import TTS_MAX_LENGTH
+from stt import NO_SPEECH_MESSAGE, stt_service
+from tts import tts_service
+
 
 def clean_text_for_tts(text: str) -> str:
     text = text.strip()
@@ -17,20 +20,6 @@ def clean_text_for_tts(text: str) -> str:
 
 
 async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
-    voice_map = {
-        "en": "en-US-AriaNeural",
-        "fr": "fr-FR-DeniseNeural",
-        "de": "de-DE-KatjaNeural",
-        "es": "es-ES-ElviraNeural",
-        "it": "it-IT-ElsaNeural",
-        "pt": "pt-PT-FernandaNeural",
-        "ru": "ru-RU-DariyaNeural",
-        "zh": "zh-CN-XiaoxiaoNeural",
-        "ja": "ja-JP-NanamiNeural",
-        "ko": "ko-KR-SunHiNeural",
-        "tr": "tr-TR-EmelNeural",
-    }
-    voice = voice_map.get(lang, "en-US-AriaNeural")
     output_file_path = os.path.join("static", "audio", f"audio-{request_id}.mp3")
 
     cleaned_text = clean_text_for_tts(text)
@@ -40,7 +29,7 @@ async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
             status_code=400, detail="Text is too short or empty after cleaning"
         )
 
-    if len(cleaned_text) > 10000:
+    if len(cleaned_text) > TTS_MAX_LENGTH:
         raise HTTPException(
             status_code=400, detail="Text is too long for TTS generation"
         )
@@ -48,8 +37,9 @@ async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
     os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
 
     try:
-        communicate = edge_tts.Communicate(cleaned_text, voice)
-        await communicate.save(output_file_path)
+        engine_name = await tts_service.synthesize_long(
+            cleaned_text, lang, output_file_path
+        )
 
         if (
             not os.path.exists(output_file_path)
@@ -69,7 +59,7 @@ async def save_speak_file(text: str, lang: str = "en", request_id: str = None):
             status_code=500, detail=f"Failed to generate speech: {str(e)}"
         ) from e
 
-    logging.info(f"Saved speak file: {output_file_path}")
+    logging.info(f"Saved speak file with {engine_name}: {output_file_path}")
     return output_file_path
 
 
@@ -174,18 +164,14 @@ def recognize_from_audio(input_file, language="tr"):
             raise Exception(f"Audio file not found: {input_file}")
 
         logging.info(f"Performing speech recognition on {input_file}...")
-        recognizer = sr.Recognizer()
-
-        with sr.AudioFile(input_file) as source:
-            audio = recognizer.record(source)
-            user_input = recognizer.recognize_google(audio, language=language)
+        user_input = stt_service.transcribe(input_file, language)
 
         logging.info(f"Recognition successful: '{user_input}'")
         return user_input
     except Exception as ex:
         e = str(ex)
         if e == "":
-            e = "No speech detected in the audio file."
+            e = NO_SPEECH_MESSAGE
         logging.error(f"Speech recognition error: {e}")
         raise Exception(f"Speech recognition failed: {e}")
 
@@ -223,16 +209,11 @@ async def process_audio_file_common(file, language="tr", is_async=False):
         temp_files.append(wav_file)
 
         try:
-            import speech_recognition as sr
-
-            recognizer = sr.Recognizer()
-            with sr.AudioFile(wav_file) as source:
-                audio = recognizer.record(source)
-                user_input = recognizer.recognize_google(audio, language=language)
+            user_input = await stt_service.transcribe_async(wav_file, language)
             logging.info(f"Recognition successful: '{user_input}'")
             return user_input
         except Exception as e:
-            msg = str(e) or "No speech detected in the audio file."
+            msg = str(e) or NO_SPEECH_MESSAGE
             logging.error(f"Speech recognition error: {msg}")
             raise HTTPException(
                 status_code=400, detail=f"Speech recognition failed: {msg}"
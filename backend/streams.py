@@ -0,0 +1,212 @@
+"""
+This module decouples response generation from the HTTP connection. Each
+generation runs in its own task and writes into a bounded buffer, and clients
+read from it by byte offset, so they can reconnect and resume a stream.
+"""
+
+import asyncio
+import json
+import logging
+from typing import AsyncGenerator
+
+from fastapi import HTTPException
+
+from config import (
+    STREAM_BUFFER_LIMIT,
+    STREAM_DISCONNECT_POLICY,
+    STREAM_MAX_STREAMS,
+    STREAM_RESUME_GRACE,
+    STREAM_TTL,
+    WORKERS,
+)
+
+SHUTDOWN_TIMEOUT = 30
+ERROR_MARKER = "$[[STREAM_ERROR]]"
+
+
+class GenerationStream:
+    """
+    Buffer of one generation. Only the last buffer_limit bytes are kept;
+    base_offset is the stream offset of the first byte still buffered.
+    """
+
+    def __init__(self, stream_id: str, owner: str, buffer_limit: int):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.buffer_limit = buffer_limit
+        self.data = bytearray()
+        self.base_offset = 0
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task = None
+
+    @property
+    def end_offset(self) -> int:
+        return self.base_offset + len(self.data)
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def append(self, chunk: bytes):
+        self.data += chunk
+        overflow = len(self.data) - self.buffer_limit
+        if overflow > 0:
+            del self.data[:overflow]
+            self.base_offset += overflow
+        self.notify()
+
+    async def run(self, source: AsyncGenerator[str, None]):
+        try:
+            async for chunk in source:
+                self.append(chunk.encode("utf-8"))
+        except asyncio.CancelledError:
+            logging.info("Generation stream %s cancelled", self.stream_id)
+            raise
+        except Exception:
+            logging.exception("Generation stream %s failed", self.stream_id)
+        finally:
+            self.done = True
+            self.notify()
+
+    async def subscribe(self, offset: int = 0) -> AsyncGenerator[bytes, None]:
+        """
+        Yield the stream from offset, waiting for new data until it ends. A
+        reader that falls behind the buffer gets an error marker instead of
+        the bytes it missed, so a cut-off response is not mistaken for a
+        complete one.
+        """
+        self.subscribers += 1
+        try:
+            while True:
+                if offset < self.base_offset:
+                    logging.warning(
+                        "Reader of stream %s fell behind the buffer", self.stream_id
+                    )
+                    yield self.error_marker(offset)
+                    return
+                if offset < self.end_offset:
+                    chunk = bytes(self.data[offset - self.base_offset :])
+                    offset += len(chunk)
+                    yield chunk
+                    continue
+                if self.done:
+                    return
+                await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+
+    def error_marker(self, offset: int) -> bytes:
+        payload = json.dumps(
+            {
+                "error": "Offset is no longer buffered for this stream",
+                "stream_id": self.stream_id,
+                "offset": offset,
+                "base_offset": self.base_offset,
+            }
+        )
+        return f"\n{ERROR_MARKER}{payload}{ERROR_MARKER}".encode("utf-8")
+
+
+class StreamRegistry:
+    """
+    Tracks running and recently finished generation streams. When the last
+    reader disconnects, a stream either keeps generating so the response is
+    persisted ('finish') or is cancelled unless a reader reconnects within
+    the grace period ('cancel'). At most max_streams are kept; the oldest
+    finished streams make room for new ones.
+
+    With several worker processes a reconnect cannot be routed back to the
+    worker that owns the stream, so streams are not resumable and 'cancel'
+    stops generation as soon as the reader leaves.
+    """
+
+    def __init__(
+        self,
+        policy: str = STREAM_DISCONNECT_POLICY,
+        buffer_limit: int = STREAM_BUFFER_LIMIT,
+        grace: float = STREAM_RESUME_GRACE,
+        ttl: float = STREAM_TTL,
+        max_streams: int = STREAM_MAX_STREAMS,
+        resumable: bool = WORKERS <= 1,
+    ):
+        self.policy = policy
+        self.buffer_limit = buffer_limit
+        self.grace = grace
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.resumable = resumable
+        self.streams: dict[str, GenerationStream] = {}
+
+    def start(
+        self, stream_id: str, owner: str, source: AsyncGenerator[str, None]
+    ) -> GenerationStream:
+        self._make_room()
+        stream = GenerationStream(stream_id, owner, self.buffer_limit)
+        stream.task = asyncio.create_task(stream.run(source))
+        stream.task.add_done_callback(lambda _: self._expire_later(stream_id))
+        self.streams[stream_id] = stream
+        return stream
+
+    def _make_room(self):
+        if len(self.streams) < self.max_streams:
+            return
+        for stream_id, stream in list(self.streams.items()):
+            if stream.done:
+                del self.streams[stream_id]
+                if len(self.streams) < self.max_streams:
+                    return
+        raise HTTPException(status_code=503, detail="Too many active streams")
+
+    def get(self, stream_id: str, owner: str) -> GenerationStream:
+        if not self.resumable:
+            raise HTTPException(
+                status_code=501,
+                detail="Streams cannot be resumed when running several workers",
+            )
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.owner != owner:
+            raise HTTPException(status_code=404, detail="Stream not found")
+        return stream
+
+    async def read(
+        self, stream: GenerationStream, offset: int = 0
+    ) -> AsyncGenerator[bytes, None]:
+        subscription = stream.subscribe(offset)
+        try:
+            async for chunk in subscription:
+                yield chunk
+        finally:
+            await subscription.aclose()
+            if stream.subscribers == 0 and not stream.done:
+                self._on_idle(stream)
+
+    def _on_idle(self, stream: GenerationStream):
+        if self.policy != "cancel":
+            logging.info(
+                "Client left stream %s, finishing generation", stream.stream_id
+            )
+            return
+        grace = self.grace if self.resumable else 0
+        asyncio.get_running_loop().call_later(grace, self._cancel_if_idle, stream)
+
+    def _cancel_if_idle(self, stream: GenerationStream):
+        if stream.subscribers == 0 and not stream.done:
+            stream.task.cancel()
+
+    def _expire_later(self, stream_id: str):
+        asyncio.get_running_loop().call_later(
+            self.ttl, self.streams.pop, stream_id, None
+        )
+
+    async def shutdown(self):
+        """Let running generations finish so their responses are persisted."""
+        tasks = [s.task for s in self.streams.values() if not s.task.done()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            for task in tasks:
+                task.cancel()
+
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,232 @@
+"""
+This module provides pluggable speech-to-text engines and a warm pool of
+worker processes that keep recognition models loaded between requests.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import wave
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import speech_recognition as sr
+
+from config import STT_ENGINE, STT_MODELS, STT_WORKERS
+
+NO_SPEECH_MESSAGE = "No speech detected in the audio file."
+
+
+def resolve_language(language: str, available) -> str | None:
+    """
+    Match a language tag such as 'en-US' against the configured languages,
+    falling back to its primary subtag ('en').
+    """
+    if not language:
+        return None
+    if language in available:
+        return language
+    primary = language.split("-")[0].lower()
+    if primary in available:
+        return primary
+    return None
+
+
+class STTEngine(ABC):
+    """Base class for speech-to-text engines."""
+
+    name = ""
+
+    def load(self):
+        """Load any models the engine needs. Called once per process."""
+
+    @abstractmethod
+    def transcribe(self, wav_file: str, language: str) -> str:
+        """Return the text spoken in a WAV file."""
+
+
+class GoogleSTTEngine(STTEngine):
+    """Online recognition through the Google Web Speech API."""
+
+    name = "google"
+
+    def transcribe(self, wav_file: str, language: str) -> str:
+        recognizer = sr.Recognizer()
+        with sr.AudioFile(wav_file) as source:
+            audio = recognizer.record(source)
+        return recognizer.recognize_google(audio, language=language)
+
+
+class VoskSTTEngine(STTEngine):
+    """Offline CPU recognition with Vosk, one model per configured language."""
+
+    name = "vosk"
+
+    def __init__(self, model_paths: dict[str, str]):
+        self.model_paths = model_paths
+        self.models = {}
+
+    def load(self):
+        import vosk
+
+        vosk.SetLogLevel(-1)
+        for language, path in self.model_paths.items():
+            if not os.path.isdir(path):
+                logging.error("Vosk model for %s not found at %s", language, path)
+                continue
+            self.models[language] = vosk.Model(path)
+            logging.info("Loaded Vosk model for %s from %s", language, path)
+
+    def transcribe(self, wav_file: str, language: str) -> str:
+        import vosk
+
+        model_language = resolve_language(language, self.models)
+        if model_language is None:
+            raise Exception(f"No offline speech model configured for '{language}'")
+
+        with wave.open(wav_file, "rb") as wav:
+            recognizer = vosk.KaldiRecognizer(
+                self.models[model_language], wav.getframerate()
+            )
+            while True:
+                frames = wav.readframes(4000)
+                if not frames:
+                    break
+                recognizer.AcceptWaveform(frames)
+
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        if not text:
+            raise Exception(NO_SPEECH_MESSAGE)
+        return text
+
+
+def create_engine(name: str = STT_ENGINE) -> STTEngine:
+    if name == "google":
+        return GoogleSTTEngine()
+    if name == "vosk":
+        return VoskSTTEngine(STT_MODELS)
+    raise ValueError(f"Unknown STT engine: {name}")
+
+
+_worker_engine: STTEngine | None = None
+
+
+def _init_worker(engine_name: str):
+    global _worker_engine
+    _worker_engine = create_engine(engine_name)
+    _worker_engine.load()
+
+
+def _worker_transcribe(wav_file: str, language: str) -> str:
+    return _worker_engine.transcribe(wav_file, language)
+
+
+def _worker_ping() -> int:
+    return os.getpid()
+
+
+class STTService:
+    """
+    Runs transcription on a pool of worker processes that each load the
+    engine's models once at startup. Workers are spawned rather than forked
+    so they do not inherit the server's threads, and a pool broken by a
+    crashed worker is replaced. With zero workers, transcription runs in a
+    thread of the current process instead.
+    """
+
+    def __init__(self, engine_name: str = STT_ENGINE, workers: int = STT_WORKERS):
+        self.engine_name = engine_name
+        self.workers = workers
+        self.pool = None
+        self.engine = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the pool or load the engine. Blocks until workers are up."""
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        if self.workers > 0:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.engine_name,),
+                )
+                pids = {
+                    f.result()
+                    for f in [
+                        self.pool.submit(_worker_ping) for _ in range(self.workers)
+                    ]
+                }
+                logging.info(
+                    "Started %d %s STT worker(s): %s",
+                    len(pids),
+                    self.engine_name,
+                    sorted(pids),
+                )
+        elif self.engine is None:
+            self.engine = create_engine(self.engine_name)
+            self.engine.load()
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+    def restart(self, broken: ProcessPoolExecutor):
+        """
+        Replace a broken pool. Requests that failed on the same pool all call
+        this, so only the first replaces it and the others reuse the new one.
+        """
+        with self.lock:
+            if self.pool is not broken:
+                return
+            logging.error("STT worker pool is broken, starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            self._start()
+
+    @property
+    def started(self) -> bool:
+        return self.pool is not None or self.engine is not None
+
+    def transcribe(self, wav_file: str, language: str) -> str:
+        self.start()
+        pool = self.pool
+        if pool is None:
+            return self.engine.transcribe(wav_file, language)
+        try:
+            return pool.submit(_worker_transcribe, wav_file, language).result()
+        except BrokenProcessPool:
+            self.restart(pool)
+            return self.pool.submit(_worker_transcribe, wav_file, language).result()
+
+    async def transcribe_async(self, wav_file: str, language: str) -> str:
+        if not self.started:
+            await asyncio.to_thread(self.start)
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        if pool is None:
+            return await loop.run_in_executor(
+                None, self.engine.transcribe, wav_file, language
+            )
+        try:
+            return await loop.run_in_executor(
+                pool, _worker_transcribe, wav_file, language
+            )
+        except BrokenProcessPool:
+            await asyncio.to_thread(self.restart, pool)
+            return await loop.run_in_executor(
+                self.pool, _worker_transcribe, wav_file, language
+            )
+
+
+stt_service = STTService()
@@ -0,0 +1,133 @@
+"""
+This module keeps a rolling summary of the messages that no longer fit in a
+channel's LLM context, so long conversations keep their earlier context.
+"""
+
+import asyncio
+import logging
+
+from chat import chat_storage_manager
+from config import SUMMARY_MODEL, SUMMARY_REFRESH_TURNS
+from messages import Message
+from ollama import ask_ollama
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant. Update the summary with the new messages. Keep names, facts, "
+    "decisions and open questions. Reply with the summary only, in at most "
+    "200 words."
+)
+
+
+def format_messages(messages: list[Message]) -> str:
+    return "\n".join(
+        f"{message.role}: {message.content}"
+        for message in messages
+        if message.role != "system" and message.content
+    )
+
+
+def unsummarized_messages(history, context, channel_summary) -> list[Message]:
+    """
+    Messages that dropped out of the context but are not in the summary yet,
+    limited to the context budget. Empty when summaries are disabled.
+    """
+    if SUMMARY_REFRESH_TURNS <= 0:
+        return []
+    cutoff = len(history) - len(context)
+    summarized_count = channel_summary.summarized_count if channel_summary else 0
+    if summarized_count > cutoff:
+        summarized_count = 0
+    return chat_storage_manager.truncate_context(
+        [
+            message
+            for message in history[summarized_count:cutoff]
+            if message.role != "system" and message.content
+        ]
+    )
+
+
+def inject_summary(chat_history, summary: str | None, unsummarized=()):
+    """
+    Insert the channel summary right after the leading system message,
+    followed by the messages that are neither summarized nor in the context.
+    """
+    injected = list(unsummarized)
+    if summary:
+        injected.insert(
+            0, Message("system", f"Summary of the earlier conversation: {summary}")
+        )
+    if not injected:
+        return chat_history
+    index = 1 if chat_history and chat_history[0].role == "system" else 0
+    return chat_history[:index] + injected + chat_history[index:]
+
+
+class ConversationSummarizer:
+    """
+    Refreshes channel summaries in background tasks once enough messages
+    have dropped out of the context window since the last refresh.
+    """
+
+    def __init__(self, refresh_turns: int = SUMMARY_REFRESH_TURNS):
+        self.refresh_messages = refresh_turns * 2
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def schedule(self, user_id: str, channel_id: str, model: str):
+        if self.refresh_messages <= 0 or channel_id in self.tasks:
+            return
+        task = asyncio.create_task(self.refresh(user_id, channel_id, model))
+        self.tasks[channel_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(channel_id, None))
+
+    async def refresh(self, user_id: str, channel_id: str, model: str):
+        try:
+            history = await asyncio.to_thread(
+                chat_storage_manager.load_chat_history, user_id, channel_id
+            )
+            context = chat_storage_manager.truncate_context(history)
+            cutoff = len(history) - len(context)
+
+            channel_summary = await asyncio.to_thread(
+                chat_storage_manager.get_channel_summary, channel_id
+            )
+            previous = channel_summary.summary if channel_summary else ""
+            summarized_count = (
+                channel_summary.summarized_count if channel_summary else 0
+            )
+            if summarized_count > cutoff:
+                previous, summarized_count = "", 0
+            if cutoff - summarized_count < self.refresh_messages:
+                return
+
+            new_messages = format_messages(history[summarized_count:cutoff])
+            prompt = f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{new_messages}"
+            summary = await ask_ollama(
+                SUMMARY_MODEL or model,
+                [Message("system", SUMMARY_PROMPT), Message("user", prompt)],
+                channel_id,
+            )
+            if not summary.strip():
+                return
+
+            await asyncio.to_thread(
+                chat_storage_manager.save_channel_summary,
+                channel_id,
+                summary.strip(),
+                cutoff,
+            )
+            logging.info(
+                "Summarized %d messages of channel %s",
+                cutoff - summarized_count,
+                channel_id,
+            )
+        except Exception:
+            logging.exception("Failed to summarize channel %s", channel_id)
+
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+conversation_summarizer = ConversationSummarizer()
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+# chat.py creates its database under the working directory on import, so
+# the tests run from a scratch directory with the backend on the path.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.chdir(tempfile.mkdtemp(prefix="yukiai-tests-"))
+
+
+class StubOllama:
+    """
+    Local stand-in for an Ollama server, running in its own thread. Tests
+    set handlers, async functions of the request, per path.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.requests = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.runner = None
+        self.url = asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def handle(self, request):
+        body = await request.json() if request.can_read_body else None
+        self.requests.append((request.path, body))
+        handler = self.handlers.get(request.path)
+        if handler is None:
+            return web.Response(status=404)
+        return await handler(request)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def make_stub_ollama():
+    """Start any number of stub servers, closed when the test ends."""
+    stubs = []
+
+    def make():
+        stubs.append(StubOllama())
+        return stubs[-1]
+
+    yield make
+    for stub in stubs:
+        stub.close()
+
+
+@pytest.fixture
+def stub_ollama(make_stub_ollama):
+    return make_stub_ollama()
+
+
+@pytest.fixture
+def clean_database():
+    """Empty the chat tables after a test that writes to the database."""
+    yield
+    import chat
+
+    with chat.open_session(write=True) as db:
+        for table in (
+            "message_embeddings",
+            "message_search",
+            "search_index_state",
+            "channel_summaries",
+            "channels",
+            "users",
+        ):
+            db.execute(chat.text(f"DELETE FROM {table}"))
+        db.commit()
@@ -0,0 +1,64 @@
+import pytest
+
+import ai
+from ai import channel_languages, detect_language, load_language_model
+
+ENGLISH = (
+    "The weather was lovely this morning, so we walked along the river and "
+    "talked about the books we have been reading. Afterwards we had coffee "
+    "in a small cafe near the old bridge and watched the boats go by."
+)
+FRENCH = (
+    "Le temps était magnifique ce matin, alors nous avons marché le long de "
+    "la rivière en parlant des livres que nous lisons. Ensuite nous avons bu "
+    "un café dans un petit bistrot près du vieux pont."
+)
+
+
+class CountingIdentifier:
+    def __init__(self):
+        self.identifier = load_language_model()
+        self.lengths = []
+
+    def classify(self, text):
+        self.lengths.append(len(text))
+        return self.identifier.classify(text)
+
+
+@pytest.fixture
+def identifier(monkeypatch):
+    channel_languages.clear()
+    counting = CountingIdentifier()
+    monkeypatch.setattr(ai, "language_identifier", counting)
+    return counting
+
+
+def test_detects_language(identifier):
+    assert detect_language(ENGLISH) == "en"
+    assert detect_language(FRENCH) == "fr"
+
+
+def test_remembered_language_short_circuits_detection(identifier):
+    assert detect_language(ENGLISH, "c1") == "en"
+    assert channel_languages["c1"] == "en"
+    identifier.lengths.clear()
+
+    assert detect_language(ENGLISH, "c1") == "en"
+    assert identifier.lengths == [ai.LANGID_CHECK_LENGTH]
+
+
+def test_channel_follows_a_language_switch(identifier):
+    detect_language(ENGLISH, "c1")
+    identifier.lengths.clear()
+
+    assert detect_language(FRENCH, "c1") == "fr"
+    assert identifier.lengths == [ai.LANGID_CHECK_LENGTH, len(FRENCH)]
+    assert channel_languages["c1"] == "fr"
+
+
+def test_low_confidence_falls_back(identifier, monkeypatch):
+    monkeypatch.setattr(ai, "LANGID_MIN_CONFIDENCE", 1.1)
+    assert detect_language(ENGLISH) == ai.LANGID_DEFAULT_LANGUAGE
+    channel_languages["c1"] = "de"
+    monkeypatch.setattr(ai, "LANGID_CHECK_LENGTH", 10000)
+    assert detect_language(FRENCH, "c1") == "de"
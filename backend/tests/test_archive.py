@@ -0,0 +1,55 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import HTTPException, UploadFile
+
+import archive
+from archive import import_ndjson
+
+ARCHIVE = (
+    b'{"type":"channel","channel_id":"c1","channel_name":"One",'
+    b'"created_at":"2024-05-01T10:00:00"}\n'
+    b'{"type":"message","channel_id":"c1","role":"user","content":"Hi"}\n'
+    b'{"type":"message","channel_id":"c1","role":"assistant","content":"Hello"}\n'
+    b"\n"
+    b'{"type":"channel","channel_id":"c2"}\n'
+)
+
+
+@pytest.fixture
+def imported(monkeypatch):
+    channels = []
+    monkeypatch.setattr(
+        archive.chat_storage_manager,
+        "import_channels",
+        lambda user_id, batch: channels.extend(batch),
+    )
+    return channels
+
+
+def run_import(data: bytes):
+    return asyncio.run(import_ndjson("u", UploadFile(io.BytesIO(data))))
+
+
+def test_import_reads_channels_and_messages(imported):
+    stats = run_import(ARCHIVE)
+    assert stats["channels"] == 2 and stats["messages"] == 2
+    assert [record.channel_id for record, _ in imported] == ["c1", "c2"]
+    assert [message.content for message in imported[0][1]] == ["Hi", "Hello"]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b"not json",
+        b'{"type":"channel"}',
+        b'{"type":"channel","channel_id":"c3","created_at":"yesterday"}',
+        b'{"type":"message","channel_id":"other","role":"user"}',
+    ],
+)
+def test_invalid_line_is_rejected(imported, line):
+    with pytest.raises(HTTPException) as error:
+        run_import(ARCHIVE + line + b"\n")
+    assert error.value.status_code == 400
+    assert "line 6" in error.value.detail
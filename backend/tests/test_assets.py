@@ -0,0 +1,53 @@
+import asyncio
+import gzip
+
+from assets import REVALIDATE_CACHE_CONTROL, AssetCache, CachedStaticFiles
+
+
+def get(files, path, headers=None):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [
+            (name.encode(), value.encode()) for name, value in (headers or {}).items()
+        ],
+    }
+    return asyncio.run(files.get_response(path, scope))
+
+
+def test_files_are_revalidated_by_etag(tmp_path):
+    (tmp_path / "bundle.js").write_text("console.log('v1');")
+    files = CachedStaticFiles(tmp_path, cache=AssetCache())
+
+    response = get(files, "bundle.js")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == REVALIDATE_CACHE_CONTROL
+    etag = response.headers["etag"]
+
+    response = get(files, "bundle.js", {"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def test_changed_file_gets_new_etag(tmp_path):
+    path = tmp_path / "bundle.js"
+    path.write_text("console.log('v1');")
+    cache = AssetCache(check_interval=0)
+    files = CachedStaticFiles(tmp_path, cache=cache)
+    etag = get(files, "bundle.js").headers["etag"]
+
+    path.write_text("console.log('version 2');")
+    response = get(files, "bundle.js", {"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.body == b"console.log('version 2');"
+
+
+def test_compressed_variant_is_selected(tmp_path):
+    body = "body { color: red; }\n" * 200
+    (tmp_path / "style.css").write_text(body)
+    files = CachedStaticFiles(tmp_path, cache=AssetCache())
+    response = get(files, "style.css", {"accept-encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(response.body).decode() == body
+    assert response.headers["vary"] == "Accept-Encoding"
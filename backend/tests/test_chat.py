@@ -0,0 +1,133 @@
+import pytest
+
+import chat
+from chat import chat_storage_manager, fts_phrase, search_match
+from messages import Message
+
+pytestmark = pytest.mark.usefixtures("clean_database")
+
+
+def test_fts_phrase_quotes_and_escapes():
+    assert fts_phrase("hello") == '"hello"'
+    assert fts_phrase('say "hi"') == '"say ""hi"""'
+
+
+def test_search_match_requires_user_and_all_terms():
+    assert search_match("u1", ["foo", "bar*"]) == (
+        'user_key : "u1" AND content : ("foo" "bar*")'
+    )
+
+
+def turns(start, end):
+    return [
+        Message("user" if i % 2 == 0 else "assistant", f"message{i} common")
+        for i in range(start, end)
+    ]
+
+
+def positions(user_id, query):
+    return sorted(
+        hit["position"] for hit in chat_storage_manager.search(user_id, query)
+    )
+
+
+def indexed_rows(channel_id):
+    with chat.open_session() as db:
+        return db.execute(
+            chat.text(
+                "SELECT count(*) FROM message_search WHERE channel_key = :channel_id"
+            ),
+            {"channel_id": channel_id},
+        ).scalar()
+
+
+def test_search_finds_messages_by_position():
+    chat_storage_manager.create_channel("search-user", "search-channel", "hello")
+    chat_storage_manager.save_chat_history(
+        "search-user",
+        "search-channel",
+        [
+            Message("system", "apple"),
+            Message("user", "apple pie"),
+            Message("assistant", "banana"),
+        ],
+    )
+    hits = chat_storage_manager.search("search-user", "apple")
+    assert [(hit["position"], hit["role"]) for hit in hits] == [(1, "user")]
+    assert chat_storage_manager.search("other-user", "apple") == []
+    assert chat_storage_manager.search("search-user", "") == []
+
+
+def test_search_snippet_escapes_message_html():
+    chat_storage_manager.create_channel("xss-user", "xss-channel", "hello")
+    chat_storage_manager.save_chat_history(
+        "xss-user",
+        "xss-channel",
+        [Message("user", "payload <img src=x onerror=alert(1)> & more")],
+    )
+    [hit] = chat_storage_manager.search("xss-user", "payload")
+    assert hit["snippet"] == (
+        "<mark>payload</mark> &lt;img src=x onerror=alert(1)&gt; &amp; more"
+    )
+
+
+def test_trimmed_history_is_indexed_incrementally(monkeypatch):
+    monkeypatch.setattr(chat, "MAX_HISTORY_LENGTH", 6)
+    monkeypatch.setattr(chat, "INDEX_PURGE_INTERVAL", 4)
+    user_id, channel_id = "trim-user", "trim-channel"
+    chat_storage_manager.create_channel(user_id, channel_id, "hello")
+
+    chat_storage_manager.append_chat_messages(user_id, channel_id, turns(0, 6))
+    assert positions(user_id, "common") == list(range(6))
+
+    removed = []
+    original = chat_storage_manager._remove_channel_from_index
+    monkeypatch.setattr(
+        chat_storage_manager,
+        "_remove_channel_from_index",
+        lambda *args, **kwargs: removed.append(args) or original(*args, **kwargs),
+    )
+    for start in range(6, 12, 2):
+        chat_storage_manager.append_chat_messages(
+            user_id, channel_id, turns(start, start + 2)
+        )
+    assert removed == []
+
+    history = chat_storage_manager.load_chat_history(user_id, channel_id)
+    assert [m.content for m in history] == [f"message{i} common" for i in range(6, 12)]
+    assert positions(user_id, "common") == list(range(6))
+    assert positions(user_id, "message3") == []
+    assert positions(user_id, "message8") == [2]
+    assert indexed_rows(channel_id) == 8
+
+
+def test_rewritten_history_is_reindexed(monkeypatch):
+    monkeypatch.setattr(chat, "MAX_HISTORY_LENGTH", 4)
+    user_id, channel_id = "rewrite-user", "rewrite-channel"
+    chat_storage_manager.create_channel(user_id, channel_id, "hello")
+    chat_storage_manager.append_chat_messages(user_id, channel_id, turns(0, 6))
+    chat_storage_manager.save_chat_history(user_id, channel_id, turns(20, 22))
+    assert positions(user_id, "common") == [0, 1]
+    assert positions(user_id, "message21") == [1]
+    assert indexed_rows(channel_id) == 2
+
+
+def test_context_keeps_recent_messages_within_budget():
+    history = [Message("user", "a" * 10), Message("assistant", "b" * 10)] * 3
+    assert chat_storage_manager.truncate_context(history, 25) == history[-2:]
+    assert chat_storage_manager.truncate_context(history, 60) == history
+    assert chat_storage_manager.truncate_context([], 10) == []
+
+
+def test_context_always_keeps_latest_turn():
+    history = [
+        Message("user", "short"),
+        Message("assistant", "short"),
+        Message("user", "x" * 50),
+        Message("assistant", "y" * 50),
+    ]
+    assert chat_storage_manager.truncate_context(history, 10) == history[2:]
+    assert chat_storage_manager.truncate_context(history[:3], 10) == history[2:3]
+    assert chat_storage_manager.truncate_context(
+        [Message("assistant", "z" * 50)], 10
+    ) == [Message("assistant", "z" * 50)]
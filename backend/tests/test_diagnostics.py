@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import diagnostics
+from diagnostics import (
+    LoopLagMonitor,
+    RequestProfiler,
+    require_diagnostics_access,
+    token_matches,
+)
+
+
+def make_request(client="127.0.0.1", headers=None):
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/api/diagnostics/loop",
+            "client": (client, 1234),
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in (headers or {}).items()
+            ],
+        }
+    )
+
+
+def allowed(request) -> bool:
+    try:
+        asyncio.run(require_diagnostics_access(request))
+    except HTTPException as error:
+        assert error.status_code == 403
+        return False
+    return True
+
+
+def test_without_token_only_local_clients_are_allowed(monkeypatch):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "")
+    assert allowed(make_request("127.0.0.1"))
+    assert allowed(make_request("::1"))
+    assert not allowed(make_request("10.0.0.5"))
+
+
+def test_token_is_required_when_configured(monkeypatch):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "secret")
+    assert not allowed(make_request("127.0.0.1"))
+    assert not allowed(make_request("10.0.0.5", {"Authorization": "Bearer wrong"}))
+    assert not allowed(make_request("10.0.0.5", {"Authorization": "Basic secret"}))
+    assert allowed(make_request("10.0.0.5", {"Authorization": "Bearer secret"}))
+
+
+def test_token_matches():
+    assert token_matches("secret", "secret")
+    assert not token_matches("secret", "")
+    assert not token_matches("", "")
+    assert not token_matches(None, "secret")
+
+
+@pytest.mark.parametrize(
+    "token, value, expected",
+    [("secret", "secret", "header"), ("secret", "1", None), ("", "1", None)],
+)
+def test_header_profiling_needs_the_token(monkeypatch, token, value, expected):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", token)
+    profiler = RequestProfiler(sample_rate=0, header="x-profile")
+    assert profiler.trigger({"x-profile": value}) == expected
+
+
+def blocking_callback():
+    time.sleep(0.3)
+
+
+def test_loop_lag_monitor_records_a_blocked_loop_with_its_stack():
+    monitor = LoopLagMonitor(threshold=0.1)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        blocking_callback()
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert monitor.stall_count == 1
+    stall = monitor.stalls[0]
+    assert stall["lag"] >= 0.1
+    assert "blocking_callback" in stall["stack"]
+    assert monitor.stats()["max_lag"] >= 0.1
+
+
+def test_loop_lag_monitor_ignores_a_responsive_loop():
+    monitor = LoopLagMonitor(threshold=0.1)
+
+    async def run():
+        monitor.start()
+        for _ in range(5):
+            await asyncio.sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert monitor.stall_count == 0
+    assert list(monitor.stalls) == []
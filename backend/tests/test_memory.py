@@ -0,0 +1,132 @@
+import asyncio
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+import chat
+import memory
+import ollama
+from chat import chat_storage_manager
+from memory import ChannelIndex, RetrievalMemory, normalize
+from messages import Message
+
+TOPICS = ("cat", "dog", "car")
+
+
+def embed(text: str) -> list[float]:
+    """Toy embedding: how often each topic word occurs, plus a small bias."""
+    words = text.lower().split()
+    return [
+        float(sum(word.startswith(topic) for word in words)) for topic in TOPICS
+    ] + [0.1]
+
+
+@pytest.fixture
+def embeddings(stub_ollama, monkeypatch):
+    async def handle_embed(request):
+        data = await request.json()
+        return web.json_response(
+            {"embeddings": [embed(text) for text in data["input"]]}
+        )
+
+    stub_ollama.handlers["/api/embed"] = handle_embed
+    host = ollama.OllamaHost(
+        stub_ollama.url, f"{stub_ollama.url}/api/chat", f"{stub_ollama.url}/api/tags"
+    )
+    host.models = [{"name": "embed"}]
+    monkeypatch.setattr(ollama.ollama_router, "hosts", [host])
+    monkeypatch.setattr(
+        ollama.ollama_router, "affinity", type(ollama.ollama_router.affinity)()
+    )
+    return stub_ollama
+
+
+pytestmark = pytest.mark.usefixtures("clean_database")
+
+
+def build_index(texts):
+    index = ChannelIndex()
+    index.add(
+        list(range(len(texts))),
+        ["user"] * len(texts),
+        texts,
+        normalize([embed(text) for text in texts]),
+    )
+    return index
+
+
+def test_search_ranks_by_cosine_similarity():
+    index = build_index(["my cat sleeps", "the dog barks", "a fast car", "cat and dog"])
+    results = index.search(normalize(embed("cat"))[0], 2, set())
+    assert [content for _, content, _ in results] == ["my cat sleeps", "cat and dog"]
+    assert results[0][2] > results[1][2]
+
+
+def test_search_skips_excluded_messages():
+    index = build_index(["my cat sleeps", "cat and dog"])
+    results = index.search(normalize(embed("cat"))[0], 2, {"my cat sleeps"})
+    assert [content for _, content, _ in results] == ["cat and dog"]
+
+
+def test_search_drops_scores_below_minimum(monkeypatch):
+    index = build_index(["my cat sleeps", "a fast car"])
+    monkeypatch.setattr(memory, "MEMORY_MIN_SCORE", 0.5)
+    results = index.search(normalize(embed("cat"))[0], 5, set())
+    assert [content for _, content, _ in results] == ["my cat sleeps"]
+
+
+def test_empty_index_returns_nothing():
+    assert ChannelIndex().search(np.ones(4, dtype=np.float32), 3, set()) == []
+
+
+def test_new_messages_are_embedded_and_recalled(embeddings):
+    chat_storage_manager.create_channel("mem-user", "mem-channel", "hello")
+    chat_storage_manager.append_chat_messages(
+        "mem-user",
+        "mem-channel",
+        [
+            Message("system", "prompt"),
+            Message("user", "tell me about cats"),
+            Message("ai", "a car has wheels"),
+        ],
+    )
+    retrieval = RetrievalMemory(model="embed", top_k=2)
+
+    async def main():
+        await retrieval.index_new_messages("mem-user", "mem-channel")
+        recalled = await retrieval.recall("mem-channel", "my cat", [])
+        excluded = await retrieval.recall(
+            "mem-channel", "my cat", [Message("user", "tell me about cats")]
+        )
+        return recalled, excluded
+
+    recalled, excluded = asyncio.run(main())
+    assert recalled[0][:2] == ("user", "tell me about cats")
+    assert all(content != "tell me about cats" for _, content, _ in excluded)
+    embedded = [
+        body["input"] for path, body in embeddings.requests if path == "/api/embed"
+    ]
+    assert embedded[0] == ["tell me about cats", "a car has wheels"]
+
+
+def test_messages_are_embedded_after_history_is_trimmed(embeddings, monkeypatch):
+    monkeypatch.setattr(chat, "MAX_HISTORY_LENGTH", 4)
+    chat_storage_manager.create_channel("trim-user", "trim-channel", "hello")
+    retrieval = RetrievalMemory(model="embed", top_k=1)
+
+    async def main():
+        for i in range(4):
+            await asyncio.to_thread(
+                chat_storage_manager.append_chat_messages,
+                "trim-user",
+                "trim-channel",
+                [Message("user", f"question {i}"), Message("ai", f"answer {i}")],
+            )
+            await retrieval.index_new_messages("trim-user", "trim-channel")
+        return await retrieval.recall("trim-channel", "dog", [])
+
+    asyncio.run(main())
+    assert chat_storage_manager.count_embedded_messages("trim-channel") == 8
+    rows = chat_storage_manager.load_message_embeddings("trim-channel")
+    assert [row.content for row in rows][-2:] == ["question 3", "answer 3"]
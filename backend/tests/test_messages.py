@@ -0,0 +1,60 @@
+from messages import (
+    ChannelRecord,
+    Message,
+    MessageRecord,
+    StatsRecord,
+    decode,
+    decode_history,
+    encode,
+    encode_chat_request,
+    encode_history,
+    encode_llm_messages,
+    record_decoder,
+)
+
+
+def test_history_round_trip():
+    history = [
+        Message("user", "Hello", created_at=1.5),
+        Message("assistant", "Hi", audio_url="/audio/a.mp3", created_at=2.0),
+        Message("system"),
+    ]
+    assert decode_history(encode_history(history)) == history
+
+
+def test_history_omits_empty_fields():
+    assert encode_history([Message("user", "Hello")]) == (
+        '[{"role":"user","content":"Hello"}]'
+    )
+
+
+def test_decode_empty_history():
+    assert decode_history(None) == []
+    assert decode_history("") == []
+
+
+def test_llm_messages_keep_only_role_and_content():
+    messages = [Message("user", 'say "hi"\n', audio_url="/a.mp3", created_at=3.0)]
+    assert decode(encode_llm_messages(messages)) == [
+        {"role": "user", "content": 'say "hi"\n'}
+    ]
+    assert decode(encode_llm_messages([])) == []
+
+
+def test_chat_request():
+    request = decode(encode_chat_request("llama3", [Message("user", "Hi")], True))
+    assert request == {
+        "model": "llama3",
+        "messages": [{"role": "user", "content": "Hi"}],
+        "stream": True,
+    }
+
+
+def test_archive_records_round_trip():
+    records = [
+        ChannelRecord("c1", "Title", "2024-01-01T00:00:00"),
+        MessageRecord("c1", "user", "Hello", created_at=1.0),
+        StatsRecord(1, 1, 0.5, 2.0),
+    ]
+    for record in records:
+        assert record_decoder.decode(encode(record)) == record
@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+import ollama
+from messages import Message
+
+HISTORY = [Message(role="user", content="Hello")]
+
+
+def make_host(url: str, models=("llama",)) -> ollama.OllamaHost:
+    host = ollama.OllamaHost(url, f"{url}/api/chat", f"{url}/api/tags")
+    host.models = [{"name": model} for model in models]
+    return host
+
+
+def chunk(content: str, done: bool = False) -> bytes:
+    message = {"role": "assistant", "content": content}
+    return json.dumps({"message": message, "done": done}).encode() + b"\n"
+
+
+def stream_handler(stub, parts, stall_after=None):
+    """
+    Stream the given parts, stalling after `stall_after` of them until the
+    returned event is set.
+    """
+    release = asyncio.Event()
+
+    async def handle(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for i, part in enumerate(parts):
+            if i == stall_after:
+                await release.wait()
+            await response.write(chunk(part, done=i == len(parts) - 1))
+        return response
+
+    stub.handlers["/api/chat"] = handle
+    return release
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(ollama.ollama_router, "hosts", [])
+    monkeypatch.setattr(
+        ollama.ollama_router, "affinity", type(ollama.ollama_router.affinity)()
+    )
+    monkeypatch.setattr(ollama, "OLLAMA_READ_TIMEOUT", 0.3)
+    return ollama.ollama_router
+
+
+async def collect(channel_id=None) -> list:
+    return [
+        part async for part in ollama.ask_ollama_stream("llama", HISTORY, channel_id)
+    ]
+
+
+def contents(parts) -> list[str]:
+    return [part["message"]["content"] for part in parts]
+
+
+def test_candidates_prefer_sticky_loaded_idle_and_fast_hosts(router):
+    sticky, loaded, idle, fast, slow, missing, down = (
+        make_host(f"http://host{i}") for i in range(7)
+    )
+    for host in (sticky, loaded, idle, fast, slow):
+        host.outstanding = 1
+        host.first_token_latency = 2.0
+    loaded.loaded_models.add("llama")
+    idle.outstanding = 0
+    fast.first_token_latency = 1.0
+    missing.models = []
+    down.healthy = False
+    router.hosts = [down, missing, slow, fast, idle, loaded, sticky]
+    router.pin("channel", sticky)
+
+    assert router.candidates("llama", "channel") == [
+        sticky,
+        loaded,
+        idle,
+        fast,
+        slow,
+    ]
+
+
+def test_candidates_fall_back_when_no_host_has_the_model(router):
+    healthy, down = make_host("http://a", ()), make_host("http://b", ())
+    down.healthy = False
+    router.hosts = [down, healthy]
+    assert router.candidates("llama") == [healthy]
+
+    healthy.healthy = False
+    assert router.candidates("llama") == [down, healthy]
+
+
+def test_stream_fails_over_when_a_host_errors(router, make_stub_ollama):
+    broken, working = make_stub_ollama(), make_stub_ollama()
+
+    async def handle_error(request):
+        return web.Response(status=500, text="model failed to load")
+
+    broken.handlers["/api/chat"] = handle_error
+    stream_handler(working, ["Hi", " there"])
+    router.hosts = [make_host(broken.url), make_host(working.url)]
+
+    assert contents(asyncio.run(collect("channel"))) == ["Hi", " there"]
+    assert router.affinity["channel"] is router.hosts[1]
+
+
+def test_stream_fails_over_when_a_host_stalls_before_the_first_token(
+    router, make_stub_ollama
+):
+    stalled, working = make_stub_ollama(), make_stub_ollama()
+    release = stream_handler(stalled, ["never"], stall_after=0)
+    stream_handler(working, ["Hi"])
+    router.hosts = [make_host(stalled.url), make_host(working.url)]
+
+    try:
+        assert contents(asyncio.run(collect())) == ["Hi"]
+    finally:
+        stalled.loop.call_soon_threadsafe(release.set)
+    assert not router.hosts[0].healthy
+    assert router.hosts[1].healthy
+
+
+def test_stream_does_not_fail_over_after_the_first_token(router, make_stub_ollama):
+    stalled, other = make_stub_ollama(), make_stub_ollama()
+    release = stream_handler(stalled, ["Hi", " there"], stall_after=1)
+    stream_handler(other, ["Other"])
+    router.hosts = [make_host(stalled.url), make_host(other.url)]
+
+    received = []
+
+    async def run():
+        async for part in ollama.ask_ollama_stream("llama", HISTORY):
+            received.append(part)
+
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(run())
+    finally:
+        stalled.loop.call_soon_threadsafe(release.set)
+    assert contents(received) == ["Hi"]
+    assert other.requests == []
+    assert router.hosts[0].healthy
+
+
+def test_stream_has_no_total_time_limit(router, stub_ollama, monkeypatch):
+    async def handle(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for part in ["a", "b", "c", "d"]:
+            await asyncio.sleep(0.2)
+            await response.write(chunk(part, done=part == "d"))
+        return response
+
+    stub_ollama.handlers["/api/chat"] = handle
+    router.hosts = [make_host(stub_ollama.url)]
+
+    assert contents(asyncio.run(collect())) == ["a", "b", "c", "d"]
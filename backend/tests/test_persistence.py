@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import persistence
+from persistence import ChatWriteQueue
+
+
+def test_turns_are_written_in_order_off_the_loop(monkeypatch):
+    batches = []
+    threads = set()
+
+    def append_chat_turns(turns):
+        threads.add(threading.get_ident())
+        batches.append([messages for _, _, messages in turns])
+
+    monkeypatch.setattr(
+        persistence.chat_storage_manager, "append_chat_turns", append_chat_turns
+    )
+
+    async def main():
+        queue = ChatWriteQueue(interval=0.01)
+        queue.start()
+        first = queue.enqueue("u", "c", ["a"])
+        queue.enqueue("u", "c", ["b"])
+        await first
+        queue.enqueue("u", "c", ["c"])
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(main())
+    assert [turn for batch in batches for turn in batch] == [["a"], ["b"], ["c"]]
+    assert threading.get_ident() not in threads
+    assert queue.task is None and not queue.pending
+    assert queue.turns_written == 3
+
+
+def test_failed_turns_are_retried(monkeypatch):
+    calls = []
+
+    def append_chat_turns(turns):
+        calls.append(len(turns))
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(
+        persistence.chat_storage_manager, "append_chat_turns", append_chat_turns
+    )
+
+    async def main():
+        queue = ChatWriteQueue(interval=0)
+        done = queue.enqueue("u", "c", ["a"])
+        await done
+        await queue.stop()
+
+    asyncio.run(main())
+    assert calls == [1, 1]
+
+
+def test_sync_waits_for_the_batch_being_written(monkeypatch):
+    written = []
+    release = threading.Event()
+
+    def append_chat_turns(turns):
+        release.wait(5)
+        written.extend(messages for _, _, messages in turns)
+
+    monkeypatch.setattr(
+        persistence.chat_storage_manager, "append_chat_turns", append_chat_turns
+    )
+
+    async def main():
+        queue = ChatWriteQueue(interval=0)
+        queue.enqueue("u", "c", ["a"])
+        while not queue.writing:
+            await asyncio.sleep(0.001)
+        assert not queue.pending
+
+        sync = asyncio.create_task(queue.sync("c"))
+        await asyncio.sleep(0.05)
+        assert not sync.done()
+        release.set()
+        await sync
+        assert written == [["a"]]
+        await queue.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from streams import ERROR_MARKER, GenerationStream, StreamRegistry
+
+
+async def source(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(stream, offset=0):
+    return b"".join([chunk async for chunk in stream.subscribe(offset)])
+
+
+def run_stream(buffer_limit, *chunks):
+    async def main():
+        stream = GenerationStream("s", "owner", buffer_limit)
+        await stream.run(source(*chunks))
+        return stream
+
+    return asyncio.run(main())
+
+
+def test_offsets_track_appended_bytes():
+    stream = run_stream(100, "abc", "de", "é")
+    assert stream.done
+    assert stream.base_offset == 0
+    assert stream.end_offset == len("abcdeé".encode())
+
+
+def test_buffer_keeps_only_the_tail():
+    stream = run_stream(4, "abc", "def", "gh")
+    assert bytes(stream.data) == b"efgh"
+    assert stream.base_offset == 4
+    assert stream.end_offset == 8
+
+
+def test_subscribe_from_offset():
+    async def main():
+        stream = GenerationStream("s", "owner", 100)
+        await stream.run(source("hello ", "world"))
+        return await collect(stream), await collect(stream, 6)
+
+    assert asyncio.run(main()) == (b"hello world", b"world")
+
+
+def test_subscriber_waits_for_new_data():
+    async def main():
+        stream = GenerationStream("s", "owner", 100)
+        reader = asyncio.create_task(collect(stream))
+        await asyncio.sleep(0)
+        stream.append(b"one ")
+        await asyncio.sleep(0)
+        stream.append(b"two")
+        stream.done = True
+        stream.notify()
+        return await reader, stream.subscribers
+
+    assert asyncio.run(main()) == (b"one two", 0)
+
+
+def test_reader_behind_the_buffer_gets_error_marker():
+    async def main():
+        stream = GenerationStream("s", "owner", 4)
+        stream.append(b"ab")
+        reader = stream.subscribe(0)
+        first = await reader.__anext__()
+        stream.append(b"cdefgh")
+        stream.done = True
+        return first, [chunk async for chunk in reader]
+
+    first, rest = asyncio.run(main())
+    assert first == b"ab"
+    assert len(rest) == 1
+    marker = rest[0].decode()
+    assert marker.startswith(f"\n{ERROR_MARKER}") and marker.endswith(ERROR_MARKER)
+    payload = json.loads(
+        marker.strip().removeprefix(ERROR_MARKER).removesuffix(ERROR_MARKER)
+    )
+    assert payload["offset"] == 2 and payload["base_offset"] == 4
+
+
+def test_registry_drops_oldest_finished_streams():
+    async def main():
+        registry = StreamRegistry(max_streams=2, ttl=60)
+        registry.start("a", "owner", source("x"))
+        registry.start("b", "owner", source("y"))
+        await asyncio.sleep(0.01)
+        registry.start("c", "owner", source("z"))
+        return list(registry.streams)
+
+    assert asyncio.run(main()) == ["b", "c"]
+
+
+def test_registry_refuses_streams_when_all_are_running():
+    async def main():
+        registry = StreamRegistry(max_streams=1, ttl=60)
+        running = asyncio.Event()
+
+        async def waiting():
+            await running.wait()
+            yield "done"
+
+        registry.start("a", "owner", waiting())
+        try:
+            registry.start("b", "owner", source("y"))
+        finally:
+            running.set()
+            await registry.shutdown()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main())
+    assert error.value.status_code == 503
+
+
+def test_streams_are_not_resumable_with_several_workers():
+    async def main():
+        registry = StreamRegistry(resumable=False)
+        registry.start("a", "owner", source("x"))
+        await asyncio.sleep(0.01)
+        registry.get("a", "owner")
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main())
+    assert error.value.status_code == 501
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+import time
+
+import pytest
+
+from stt import STTService
+
+
+@pytest.fixture
+def service():
+    service = STTService("google", workers=1)
+    service.start()
+    yield service
+    service.shutdown()
+
+
+def break_pool(service):
+    broken = service.pool
+    with pytest.raises(Exception):
+        broken.submit(os._exit, 1).result()
+    return broken
+
+
+def test_concurrent_requests_replace_a_broken_pool_once(service, caplog, tmp_path):
+    broken = break_pool(service)
+    missing = str(tmp_path / "missing.wav")
+    gaps = []
+
+    async def tick(stop):
+        last = time.monotonic()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+
+    async def main():
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(tick(stop))
+        results = await asyncio.gather(
+            service.transcribe_async(missing, "en"),
+            service.transcribe_async(missing, "en"),
+            return_exceptions=True,
+        )
+        stop.set()
+        await ticker
+        return results
+
+    with caplog.at_level(logging.ERROR):
+        results = asyncio.run(main())
+
+    # Both retries ran on the new pool and failed only on the missing file.
+    assert all(isinstance(result, FileNotFoundError) for result in results)
+    assert service.pool is not broken
+    assert caplog.text.count("STT worker pool is broken") == 1
+    assert max(gaps) < 0.5
+
+
+def test_restart_ignores_a_pool_that_was_already_replaced(service):
+    broken = break_pool(service)
+    service.restart(broken)
+    replacement = service.pool
+    service.restart(broken)
+    assert service.pool is replacement
@@ -0,0 +1,36 @@
+from chat import ChannelSummary
+from messages import Message
+from summary import inject_summary, unsummarized_messages
+
+HISTORY = [Message("system", "prompt")] + [
+    Message("user" if i % 2 == 0 else "assistant", f"m{i}") for i in range(8)
+]
+
+
+def test_unsummarized_messages_fill_the_gap():
+    context = HISTORY[-2:]
+    summary = ChannelSummary(summary="earlier", summarized_count=3)
+    assert unsummarized_messages(HISTORY, context, summary) == HISTORY[3:7]
+
+
+def test_unsummarized_messages_without_summary():
+    assert unsummarized_messages(HISTORY, HISTORY[-2:], None) == HISTORY[1:7]
+    assert unsummarized_messages(HISTORY, HISTORY, None) == []
+
+
+def test_stale_summary_count_is_ignored():
+    summary = ChannelSummary(summary="earlier", summarized_count=20)
+    assert unsummarized_messages(HISTORY, HISTORY[-2:], summary) == HISTORY[1:7]
+
+
+def test_inject_summary_after_system_message():
+    context = [Message("system", "prompt"), Message("user", "now")]
+    gap = [Message("user", "before")]
+    assert inject_summary(context, "earlier", gap) == [
+        Message("system", "prompt"),
+        Message("system", "Summary of the earlier conversation: earlier"),
+        Message("user", "before"),
+        Message("user", "now"),
+    ]
+    assert inject_summary(context, None, gap) == [context[0], gap[0], context[1]]
+    assert inject_summary(context, None) is context
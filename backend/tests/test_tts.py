@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import pytest
+
+import tts
+from tts import TTSEngine, TTSService, split_text
+
+
+def test_short_text_is_one_chunk():
+    assert split_text("Hello there.", 100) == ["Hello there."]
+
+
+def test_empty_text():
+    assert split_text("", 100) == []
+    assert split_text("\n\n  \n", 100) == []
+
+
+def test_paragraphs_are_joined_up_to_the_limit():
+    text = "First paragraph.\n\nSecond paragraph.\n\nThird one."
+    assert split_text(text, 40) == ["First paragraph. Second paragraph.", "Third one."]
+
+
+def test_long_paragraph_splits_at_sentences():
+    text = "One two three. Four five six. Seven eight nine."
+    assert split_text(text, 20) == [
+        "One two three.",
+        "Four five six.",
+        "Seven eight nine.",
+    ]
+
+
+def test_long_sentence_splits_at_words():
+    chunks = split_text("alpha beta gamma delta epsilon", 12)
+    assert chunks == ["alpha beta", "gamma delta", "epsilon"]
+
+
+def test_unbroken_word_is_cut():
+    assert split_text("x" * 25, 10) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_chunks_respect_limit_and_keep_words():
+    text = " ".join(f"word{i}." for i in range(500))
+    chunks = split_text(text, 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+class StubEngine(TTSEngine):
+    """Engine that sleeps for a delay and then fails or writes a file."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.delay = 0.0
+        self.error = None
+        self.calls = 0
+
+    async def synthesize(self, text: str, lang: str, output_file: str):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        with open(output_file, "w") as f:
+            f.write(self.name)
+
+
+@pytest.fixture
+def make_service(monkeypatch):
+    monkeypatch.setattr(tts, "create_engine", StubEngine)
+
+    def make(**kwargs):
+        options = {"timeout": 1.0, "latency_budget": 0, "cooldown": 60}
+        options.update(kwargs)
+        service = TTSService(["first", "second"], concurrency=2, **options)
+        return service, *service.engines
+
+    return make
+
+
+def synthesize(service: TTSService) -> str:
+    return asyncio.run(service.synthesize("Hello", "en", "speech.mp3"))
+
+
+def test_service_prefers_configured_order(make_service):
+    service, first, second = make_service()
+    assert synthesize(service) == "first"
+    assert synthesize(service) == "first"
+    assert (first.calls, second.calls) == (2, 0)
+
+
+def test_service_demotes_a_failing_engine(make_service):
+    service, first, second = make_service()
+    first.error = RuntimeError("voice service down")
+
+    assert synthesize(service) == "second"
+    assert [engine.name for engine in service.ranked_engines()] == ["second", "first"]
+
+    first.error = None
+    assert synthesize(service) == "second"
+    assert first.calls == 1
+
+
+def test_service_demotes_an_engine_that_times_out(make_service):
+    service, first, second = make_service(timeout=0.05)
+    first.delay = 1.0
+
+    assert synthesize(service) == "second"
+    assert service.ranked_engines()[0] is second
+
+
+def test_service_demotes_an_engine_over_the_latency_budget(make_service):
+    service, first, second = make_service(latency_budget=0.05)
+    first.delay = 0.1
+
+    # The slow synthesis still succeeds, but later requests avoid the engine.
+    assert synthesize(service) == "first"
+    assert service.ranked_engines()[0] is second
+    assert synthesize(service) == "second"
+
+
+def test_service_restores_an_engine_after_the_cooldown(make_service):
+    service, first, second = make_service(cooldown=0.1)
+    first.error = RuntimeError("voice service down")
+    assert synthesize(service) == "second"
+
+    first.error = None
+    time.sleep(0.15)
+    assert service.ranked_engines()[0] is first
+    assert synthesize(service) == "first"
+
+
+def test_service_raises_the_last_error_when_every_engine_fails(make_service):
+    service, first, second = make_service()
+    first.error = RuntimeError("first down")
+    second.error = RuntimeError("second down")
+
+    with pytest.raises(RuntimeError, match="second down"):
+        synthesize(service)
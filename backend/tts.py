@@ -0,0 +1,417 @@
+"""
+This module provides pluggable text-to-speech engines, with a concurrency
+limit and fallback from the preferred engine to the other configured ones.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+import wave
+from abc import ABC, abstractmethod
+from tempfile import gettempdir
+
+import edge_tts
+
+from config import (
+    EDGE_TTS_VOICES,
+    ESPEAK_VOICES,
+    PIPER_VOICES,
+    TTS_CHUNK_PARALLELISM,
+    TTS_CHUNK_SIZE,
+    TTS_CONCURRENCY,
+    TTS_ENGINE_COOLDOWN,
+    TTS_ENGINES,
+    TTS_LATENCY_BUDGET,
+    TTS_TIMEOUT,
+)
+from stt import resolve_language
+
+DEFAULT_EDGE_VOICES = {
+    "en": "en-US-AriaNeural",
+    "fr": "fr-FR-DeniseNeural",
+    "de": "de-DE-KatjaNeural",
+    "es": "es-ES-ElviraNeural",
+    "it": "it-IT-ElsaNeural",
+    "pt": "pt-PT-FernandaNeural",
+    "ru": "ru-RU-DariyaNeural",
+    "zh": "zh-CN-XiaoxiaoNeural",
+    "ja": "ja-JP-NanamiNeural",
+    "ko": "ko-KR-SunHiNeural",
+    "tr": "tr-TR-EmelNeural",
+}
+
+DEFAULT_ESPEAK_VOICES = {
+    "en": "en-us",
+    "fr": "fr-fr",
+    "de": "de",
+    "es": "es",
+    "it": "it",
+    "pt": "pt",
+    "ru": "ru",
+    "zh": "cmn",
+    "ja": "ja",
+    "ko": "ko",
+    "tr": "tr",
+}
+
+LATENCY_SMOOTHING = 0.3
+
+
+async def convert_wav_to_mp3(wav_file: str, mp3_file: str):
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-i",
+        wav_file,
+        "-codec:a",
+        "libmp3lame",
+        "-q:a",
+        "4",
+        "-y",
+        mp3_file,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise Exception(f"MP3 conversion failed: {stderr.decode(errors='ignore')}")
+
+
+def split_text(text: str, max_chars: int = TTS_CHUNK_SIZE) -> list[str]:
+    """
+    Split text into chunks of at most max_chars, breaking at paragraph and
+    sentence boundaries where possible and at word boundaries otherwise.
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if sentence:
+                pieces.append(sentence)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def concat_mp3_files(input_files: list[str], output_file: str):
+    list_file = os.path.join(gettempdir(), f"tts_concat_{uuid.uuid4()}.txt")
+    with open(list_file, "w", encoding="utf-8") as f:
+        for path in input_files:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_file,
+            "-c",
+            "copy",
+            "-y",
+            output_file,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise Exception(
+                f"MP3 concatenation failed: {stderr.decode(errors='ignore')}"
+            )
+    finally:
+        os.remove(list_file)
+
+
+class TTSEngine(ABC):
+    """Base class for text-to-speech engines."""
+
+    name = ""
+
+    def __init__(self, voices: dict[str, str]):
+        self.voices = voices
+
+    def load(self):
+        """Preload voice models. Called once at startup."""
+
+    def voice_for(self, lang: str) -> str:
+        voice_lang = resolve_language(lang, self.voices) or "en"
+        if voice_lang not in self.voices:
+            raise Exception(f"No {self.name} voice configured for '{lang}'")
+        return self.voices[voice_lang]
+
+    @abstractmethod
+    async def synthesize(self, text: str, lang: str, output_file: str):
+        """Write the speech for text to output_file as MP3."""
+
+
+class EdgeTTSEngine(TTSEngine):
+    """Online synthesis through the Microsoft Edge TTS service."""
+
+    name = "edge"
+
+    async def synthesize(self, text: str, lang: str, output_file: str):
+        communicate = edge_tts.Communicate(text, self.voice_for(lang))
+        await communicate.save(output_file)
+
+
+class LocalTTSEngine(TTSEngine):
+    """Base class for engines that render WAV locally and convert it to MP3."""
+
+    async def synthesize(self, text: str, lang: str, output_file: str):
+        wav_file = os.path.join(gettempdir(), f"tts_{uuid.uuid4()}.wav")
+        try:
+            await self.synthesize_wav(text, lang, wav_file)
+            await convert_wav_to_mp3(wav_file, output_file)
+        finally:
+            if os.path.exists(wav_file):
+                os.remove(wav_file)
+
+    @abstractmethod
+    async def synthesize_wav(self, text: str, lang: str, wav_file: str):
+        """Write the speech for text to wav_file."""
+
+
+class PiperTTSEngine(LocalTTSEngine):
+    """Offline neural synthesis with Piper voice models."""
+
+    name = "piper"
+
+    def __init__(self, voices: dict[str, str]):
+        super().__init__(voices)
+        self.models = {}
+
+    def load(self):
+        from piper import PiperVoice
+
+        for lang, path in self.voices.items():
+            if not os.path.isfile(path):
+                logging.error("Piper voice for %s not found at %s", lang, path)
+                continue
+            self.models[path] = PiperVoice.load(path)
+            logging.info("Loaded Piper voice for %s from %s", lang, path)
+
+    def _render(self, text: str, voice_path: str, wav_file: str):
+        voice = self.models[voice_path]
+        with wave.open(wav_file, "wb") as wav:
+            if hasattr(voice, "synthesize_wav"):
+                voice.synthesize_wav(text, wav)
+            else:
+                voice.synthesize(text, wav)
+
+    async def synthesize_wav(self, text: str, lang: str, wav_file: str):
+        voice_path = self.voice_for(lang)
+        if voice_path not in self.models:
+            raise Exception(f"Piper voice for '{lang}' is not loaded")
+        await asyncio.to_thread(self._render, text, voice_path, wav_file)
+
+
+class EspeakTTSEngine(LocalTTSEngine):
+    """Offline formant synthesis with the espeak-ng command line tool."""
+
+    name = "espeak"
+
+    def load(self):
+        if not shutil.which("espeak-ng"):
+            logging.error("espeak-ng executable not found in PATH")
+
+    async def synthesize_wav(self, text: str, lang: str, wav_file: str):
+        process = await asyncio.create_subprocess_exec(
+            "espeak-ng",
+            "-v",
+            self.voice_for(lang),
+            "-w",
+            wav_file,
+            "--stdin",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate(text.encode("utf-8"))
+        if process.returncode != 0:
+            raise Exception(f"espeak-ng failed: {stderr.decode(errors='ignore')}")
+
+
+def create_engine(name: str) -> TTSEngine:
+    if name == "edge":
+        return EdgeTTSEngine({**DEFAULT_EDGE_VOICES, **EDGE_TTS_VOICES})
+    if name == "piper":
+        return PiperTTSEngine(PIPER_VOICES)
+    if name == "espeak":
+        return EspeakTTSEngine({**DEFAULT_ESPEAK_VOICES, **ESPEAK_VOICES})
+    raise ValueError(f"Unknown TTS engine: {name}")
+
+
+class TTSService:
+    """
+    Synthesizes speech with the first configured engine that is not demoted.
+    An engine that fails, exceeds the timeout or whose moving average
+    synthesis time exceeds the latency budget is demoted for the cooldown
+    period, during which the next engines are preferred.
+    """
+
+    def __init__(
+        self,
+        engine_names: list[str] = TTS_ENGINES,
+        concurrency: int = TTS_CONCURRENCY,
+        timeout: float = TTS_TIMEOUT,
+        latency_budget: float = TTS_LATENCY_BUDGET,
+        cooldown: float = TTS_ENGINE_COOLDOWN,
+    ):
+        self.engines = [create_engine(name) for name in engine_names]
+        self.timeout = timeout
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latency = {engine.name: 0.0 for engine in self.engines}
+        self.demoted_until = {engine.name: 0.0 for engine in self.engines}
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        for engine in self.engines:
+            try:
+                engine.load()
+            except Exception as e:
+                logging.error("Failed to load %s TTS engine: %s", engine.name, e)
+        self.loaded = True
+
+    def _record(self, engine_name: str, elapsed: float):
+        previous = self.latency[engine_name]
+        if previous == 0.0:
+            self.latency[engine_name] = elapsed
+        else:
+            self.latency[engine_name] = (
+                LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * previous
+            )
+        if 0 < self.latency_budget < self.latency[engine_name]:
+            self._demote(
+                engine_name,
+                f"average latency {self.latency[engine_name]:.2f}s is over budget",
+            )
+
+    def _demote(self, engine_name: str, reason: str):
+        logging.warning(
+            "Demoting %s TTS engine for %.0f seconds: %s",
+            engine_name,
+            self.cooldown,
+            reason,
+        )
+        self.demoted_until[engine_name] = time.monotonic() + self.cooldown
+        self.latency[engine_name] = 0.0
+
+    def ranked_engines(self) -> list[TTSEngine]:
+        """Engines in configured order, with demoted engines moved last."""
+        now = time.monotonic()
+        return sorted(
+            self.engines, key=lambda engine: self.demoted_until[engine.name] > now
+        )
+
+    async def _synthesize_with(
+        self, engine: TTSEngine, text: str, lang: str, output_file: str
+    ):
+        async with self.semaphore:
+            start_time = time.time()
+            await asyncio.wait_for(
+                engine.synthesize(text, lang, output_file), self.timeout
+            )
+        self._record(engine.name, time.time() - start_time)
+
+    async def _with_fallback(self, job):
+        """Run job(engine) with each ranked engine until one succeeds."""
+        self.load()
+        last_error = None
+        for engine in self.ranked_engines():
+            try:
+                await job(engine)
+            except Exception as e:
+                self._demote(engine.name, repr(e))
+                last_error = e
+                continue
+            return engine.name
+        raise last_error or Exception("No TTS engine configured")
+
+    async def synthesize(self, text: str, lang: str, output_file: str):
+        return await self._with_fallback(
+            lambda engine: self._synthesize_with(engine, text, lang, output_file)
+        )
+
+    async def synthesize_long(
+        self,
+        text: str,
+        lang: str,
+        output_file: str,
+        parallelism: int = TTS_CHUNK_PARALLELISM,
+    ):
+        """
+        Synthesize text of any length by rendering sentence-aligned chunks
+        concurrently and stitching them into a single MP3. All chunks use
+        the same engine so the voice and audio format match; if any chunk
+        fails, the whole response is rendered again with the next engine.
+        """
+        chunks = split_text(text)
+        if len(chunks) <= 1:
+            return await self.synthesize(text, lang, output_file)
+
+        limit = asyncio.Semaphore(parallelism)
+
+        async def render(engine: TTSEngine, chunk: str, chunk_file: str):
+            async with limit:
+                await self._synthesize_with(engine, chunk, lang, chunk_file)
+
+        async def render_all(engine: TTSEngine):
+            chunk_files = [
+                f"{os.path.splitext(output_file)[0]}.{engine.name}.part{index}.mp3"
+                for index in range(len(chunks))
+            ]
+            tasks = [
+                asyncio.create_task(render(engine, chunk, path))
+                for chunk, path in zip(chunks, chunk_files)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+                await concat_mp3_files(chunk_files, output_file)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                for path in chunk_files:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        engine_name = await self._with_fallback(render_all)
+        logging.info(
+            "Synthesized %d chunks with %s and parallelism %d",
+            len(chunks),
+            engine_name,
+            parallelism,
+        )
+        return engine_name
+
+
+tts_service = TTSService()